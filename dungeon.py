@@ -4,6 +4,14 @@ import random
 import pickle
 import os
 import re
+import heapq
+import array
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import numpy as np
+except ImportError: # Optional: only the array tile storage needs it
+    np = None
 
 # Constants
 TILES_HARD_ROCK = '^' # Indestructible
@@ -54,7 +62,184 @@ COLOR_SPLASH_BLACK = 24
 
 KEY_QUIT = ord('q')
 
+DIRECTIONS_4 = [(0, 1), (0, -1), (1, 0), (-1, 0)]
+DIRECTIONS_8 = [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+# Pathfinding modes
+PATH_ASTAR = 'ASTAR' # Plain A* (any terrain)
+PATH_JPS = 'JPS'     # Jump Point Search (fast on open floor)
+PATH_HPA = 'HPA'     # Hierarchical (cluster graph) for long trips
+
+MAP_WIDTH = 113
+MAP_HEIGHT = 35
+CLUSTER_SIZE = 10 # HPA* cluster edge in tiles
+
+# Octile step costs (x10 so we stay in integers)
+COST_STRAIGHT = 10
+COST_DIAGONAL = 14
+
+# Idle worker jobs (Map.find_jobs)
+JOB_PICKUP = 'PICKUP'       # Dropped gold on the floor
+JOB_CLAIM = 'CLAIM'         # Unclaimed floor next to our territory
+JOB_REINFORCE = 'REINFORCE' # Bare dirt wall
+JOB_DIG = 'DIG'             # Tagged rock/gold
+
+# Cross-check Census counts against a full scan on every query (slow)
+CENSUS_DEBUG = False
+# Check the treasury ledger against the tiles and total_gold after every change (slow)
+LEDGER_DEBUG = False
+TREASURY_CAPACITY = 500 # Gold per treasury tile
+
+# Map tile storage. Map(storage=...) picks the backend, defaulting to
+# TILE_STORAGE. The arrays backend is only used when NumPy imports; without
+# it (or for saves made with it, loaded without it) the map quietly keeps
+# or converts back to Tile objects, so the game runs the same either way.
+TILE_STORAGE_OBJECTS = 'objects' # List of rows of Tile objects
+TILE_STORAGE_ARRAYS = 'arrays'   # TileStore (one NumPy array per field), falls back to objects without NumPy
+TILE_STORAGE = TILE_STORAGE_OBJECTS
+
+# Creature states
+STATE_IDLE = 0
+STATE_STATIC = 1 # Training dummies
+STATE_MOVING_DIG = 2
+STATE_DIGGING = 3
+STATE_MOVING_REINFORCE = 4
+STATE_REINFORCING = 5
+STATE_MOVING_CLAIM = 6
+STATE_CLAIMING = 7
+STATE_MOVING_PICKUP = 8
+STATE_RETURNING_GOLD = 9
+STATE_MOVING_DROP = 10
+STATE_UNCONSCIOUS = 11
+STATE_SEEKING_WAGE = 12
+STATE_CONSTRUCTING_BED = 13
+STATE_WANT_TRAIN = 14
+STATE_MOVING_TRAIN = 15
+STATE_TRAINING = 16
+STATE_MOVING_EAT = 17
+STATE_EATING = 18
+STATE_PATROLLING = 19
+STATE_LEAVING = 20
+# States by their old string names (saves from before int states)
+STATE_BY_NAME = {
+    'IDLE': STATE_IDLE, 'STATIC': STATE_STATIC, 'MOVING_DIG': STATE_MOVING_DIG,
+    'DIGGING': STATE_DIGGING, 'MOVING_REINFORCE': STATE_MOVING_REINFORCE,
+    'REINFORCING': STATE_REINFORCING, 'MOVING_CLAIM': STATE_MOVING_CLAIM,
+    'CLAIMING': STATE_CLAIMING, 'MOVING_PICKUP': STATE_MOVING_PICKUP,
+    'RETURNING_GOLD': STATE_RETURNING_GOLD, 'MOVING_DROP': STATE_MOVING_DROP,
+    'UNCONSCIOUS': STATE_UNCONSCIOUS, 'SEEKING_WAGE': STATE_SEEKING_WAGE,
+    'CONSTRUCTING_BED': STATE_CONSTRUCTING_BED, 'WANT_TRAIN': STATE_WANT_TRAIN,
+    'MOVING_TRAIN': STATE_MOVING_TRAIN, 'TRAINING': STATE_TRAINING, 'MOVING_EAT': STATE_MOVING_EAT,
+    'EATING': STATE_EATING, 'PATROLLING': STATE_PATROLLING, 'LEAVING': STATE_LEAVING,
+}
+STATE_NAMES = {value: name for name, value in STATE_BY_NAME.items()}
+
+# Creature states that count as working on a job (TargetTable)
+TARGET_JOBS = {
+    STATE_MOVING_PICKUP: JOB_PICKUP,
+    STATE_MOVING_CLAIM: JOB_CLAIM, STATE_CLAIMING: JOB_CLAIM,
+    STATE_MOVING_REINFORCE: JOB_REINFORCE, STATE_REINFORCING: JOB_REINFORCE,
+    STATE_MOVING_DIG: JOB_DIG, STATE_DIGGING: JOB_DIG,
+}
+MAX_PER_TARGET = 3 # Imps allowed on one target tile
+
+# Job -> state an idle imp takes it up in
+JOB_STATES = {
+    JOB_PICKUP: STATE_MOVING_PICKUP, JOB_CLAIM: STATE_MOVING_CLAIM,
+    JOB_REINFORCE: STATE_MOVING_REINFORCE, JOB_DIG: STATE_MOVING_DIG,
+}
+
+# Desires a creature weighs at the start of its tick
+DESIRE_EAT = 'EAT'
+DESIRE_SEEK_WAGE = 'SEEK_WAGE'
+DESIRE_BUILD_BED = 'BUILD_BED'
+DESIRE_TRAIN = 'TRAIN'
+DESIRE_WORK = 'WORK'
+DESIRE_PATROL = 'PATROL'
+DESIRE_IDLE = 'IDLE'
+# Desire -> EntityManager method scoring it (None: doesn't apply)
+DESIRE_SCORERS = {
+    DESIRE_EAT: 'want_food', DESIRE_SEEK_WAGE: 'want_wage', DESIRE_BUILD_BED: 'want_bed',
+    DESIRE_TRAIN: 'want_training', DESIRE_WORK: 'want_work', DESIRE_PATROL: 'want_patrol',
+    DESIRE_IDLE: 'want_rest',
+}
+# Desire -> (state it switches to, states that already serve it)
+DESIRE_STATES = {
+    DESIRE_EAT: (STATE_MOVING_EAT, (STATE_EATING, STATE_MOVING_EAT)),
+    DESIRE_SEEK_WAGE: (STATE_SEEKING_WAGE, (STATE_SEEKING_WAGE,)),
+    DESIRE_TRAIN: (STATE_WANT_TRAIN, (STATE_TRAINING, STATE_MOVING_TRAIN)),
+    DESIRE_PATROL: (STATE_PATROLLING, (STATE_PATROLLING,)),
+}
+# Switching to these states first needs a target (EntityManager method, False cancels)
+STATE_ENTRY = {STATE_MOVING_EAT: 'aim_at_farm'}
+# States whose target is checked at the start of every tick (EntityManager
+# method taking the target); a failed check, or None, drops back to IDLE
+TARGET_CHECKS = {
+    STATE_STATIC: None, STATE_MOVING_DROP: None, STATE_MOVING_TRAIN: None,
+    STATE_DIGGING: 'can_dig', STATE_REINFORCING: 'can_reinforce', STATE_CLAIMING: 'can_claim',
+}
+# States an imp keeps between ticks; any other drops back to IDLE
+IMP_STATES = frozenset((
+    STATE_IDLE, STATE_RETURNING_GOLD, STATE_MOVING_PICKUP,
+    STATE_MOVING_DIG, STATE_MOVING_REINFORCE, STATE_MOVING_CLAIM,
+    STATE_DIGGING, STATE_REINFORCING, STATE_CLAIMING,
+))
+
+STATE_ANY = -1 # Phase key matching every state
+# Creature type -> how its tick runs (see CreatureBehaviour):
+#   desires: weighed in this order, the earlier one winning a tie
+#   hungry:  hunger grows every tick
+#   phases:  run in order; each maps a state to the EntityManager handler
+#            for creatures in it, and a handler returning True ends the tick
+CREATURE_BEHAVIOURS = {
+    'IMP': {
+        'desires': (DESIRE_WORK, DESIRE_IDLE),
+        'hungry': False,
+        'phases': (
+            {STATE_ANY: 'drop_stale_job'},
+            {STATE_RETURNING_GOLD: 'return_gold'},
+            {
+                STATE_MOVING_PICKUP: 'pick_up_gold', STATE_MOVING_DIG: 'walk_to_job',
+                STATE_MOVING_REINFORCE: 'walk_to_job', STATE_MOVING_CLAIM: 'walk_to_job',
+                STATE_DIGGING: 'dig', STATE_REINFORCING: 'reinforce', STATE_CLAIMING: 'claim',
+                STATE_IDLE: 'wander',
+            },
+            {STATE_ANY: 'check_mood'},
+            {STATE_LEAVING: 'leave'},
+        ),
+    },
+    'GOBARR': {
+        'desires': (DESIRE_EAT, DESIRE_SEEK_WAGE, DESIRE_BUILD_BED, DESIRE_TRAIN, DESIRE_PATROL, DESIRE_IDLE),
+        'hungry': True,
+        'phases': (
+            {STATE_IDLE: 'look_for_bed', STATE_WANT_TRAIN: 'choose_training'},
+            {
+                STATE_SEEKING_WAGE: 'seek_wage', STATE_CONSTRUCTING_BED: 'build_bed',
+                STATE_TRAINING: 'train', STATE_MOVING_EAT: 'walk_to_farm', STATE_EATING: 'eat',
+                STATE_PATROLLING: 'patrol',
+            },
+        ),
+    },
+    'DUMMY': {
+        'desires': (DESIRE_IDLE,),
+        'hungry': False,
+        'phases': (),
+    },
+}
+
+# Path service batches smaller than this are solved in-process
+PATH_BATCH_MIN = 8
+# Most worker processes in the (process-wide) path search pool
+PATH_WORKERS_MAX = 4
+
+# Shared flow field destinations
+FLOW_HEART = 'HEART'
+FLOW_PORTAL = 'PORTAL'
+FLOW_TREASURY = 'TREASURY' # Any treasury tile with free space
+
 class Tile:
+    __slots__ = ('char', 'x', 'y', 'tagged', 'claimed', 'is_solid', 'gold_value', 'gold_stored', 'progress', 'timestamp', 'creator_type', 'owner')
+
     def __init__(self, char, x, y):
         self.char = char
         self.x = x
@@ -69,14 +254,2113 @@ class Tile:
         self.creator_type = None # Track who built this tile (for beds)
         self.owner = 0 # 0 = player, 1+ = enemies
 
-class Map:
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in Tile.__slots__)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict): # Saves from before __slots__
+            Tile.__init__(self, state['char'], state['x'], state['y'])
+            state = [state.get(name, getattr(self, name)) for name in Tile.__slots__]
+        for name, value in zip(Tile.__slots__, state):
+            setattr(self, name, value)
+
+class SharedTile(Tile):
+    # Flyweight for untouched deep rock: one read-only instance per char,
+    # shared by every such cell, with no position (x and y are None).
+    # Map.own_tile() swaps in a private Tile before a cell is changed.
+    __slots__ = ()
+
+    def __init__(self, char):
+        proto = Tile(char, None, None)
+        for name in Tile.__slots__:
+            object.__setattr__(self, name, getattr(proto, name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("shared %r tile is read-only, use Map.own_tile()" % self.char)
+
+    def __reduce__(self):
+        return (shared_tile, (self.char,))
+
+    def untouched(self, tile):
+        # tile has exactly the fields a fresh tile of this char would have
+        return all(getattr(tile, name) == getattr(self, name) for name in Tile.__slots__ if name not in ('x', 'y'))
+
+SHARED_ROCK = {char: SharedTile(char) for char in (TILES_SOFT_ROCK, TILES_HARD_ROCK)}
+
+def shared_tile(char):
+    return SHARED_ROCK[char]
+
+def _store_field(name, cast):
+    # TileView property reading/writing one TileStore column
+    def get(self):
+        return cast(getattr(self.store, name)[self.i])
+    def put(self, value):
+        getattr(self.store, name)[self.i] = value
+    return property(get, put)
+
+class TileView:
+    # Tile-like handle on one cell of a TileStore. Views are made on demand,
+    # so compare them with == (same cell), not `is`.
+    __slots__ = ('store', 'x', 'y', 'i')
+
+    def __init__(self, store, x, y):
+        self.store = store
+        self.x = x
+        self.y = y
+        self.i = y * store.width + x
+
+    def __eq__(self, other):
+        return isinstance(other, TileView) and other.store is self.store and other.i == self.i
+
+    def __hash__(self):
+        return self.i
+
+    @property
+    def char(self):
+        return self.store.chars[self.store.code[self.i]]
+
+    @char.setter
+    def char(self, value):
+        self.store.code[self.i] = self.store.code_of(value)
+
+    @property
+    def creator_type(self):
+        return self.store.creator_type.get(self.i)
+
+    @creator_type.setter
+    def creator_type(self, value):
+        if value is None: self.store.creator_type.pop(self.i, None)
+        else: self.store.creator_type[self.i] = value
+
+    is_solid = _store_field('is_solid', bool)
+    tagged = _store_field('tagged', bool)
+    claimed = _store_field('claimed', bool)
+    gold_value = _store_field('gold_value', int)
+    gold_stored = _store_field('gold_stored', int)
+    progress = _store_field('progress', int)
+    timestamp = _store_field('timestamp', float)
+    owner = _store_field('owner', int)
+
+class TileRow:
+    # store[y]: lets TileStore be indexed like the list of rows
+    __slots__ = ('store', 'y')
+
+    def __init__(self, store, y):
+        self.store = store
+        self.y = y
+
+    def __len__(self):
+        return self.store.width
+
+    def __getitem__(self, x):
+        if x < 0: x += self.store.width
+        if not 0 <= x < self.store.width: raise IndexError(x)
+        return TileView(self.store, x, self.y)
+
+    def __iter__(self):
+        for x in range(self.store.width):
+            yield TileView(self.store, x, self.y)
+
+class TileStore:
+    # Structure-of-arrays tile storage: each Tile field is one flat array
+    # indexed y * width + x, chars are small int codes into self.chars and
+    # creator_type (almost always None) is a sparse dict. store[y][x] gives
+    # a TileView, so code written against Map.tiles keeps working, while
+    # whole-map questions (counts, totals, masks) run as array operations.
+    COLUMNS = (
+        # name, NumPy dtype, array typecode (for saves)
+        ('code', 'uint8', 'B'),
+        ('is_solid', 'bool', 'B'),
+        ('tagged', 'bool', 'B'),
+        ('claimed', 'bool', 'B'),
+        ('gold_value', 'int32', 'i'),
+        ('gold_stored', 'int32', 'i'),
+        ('progress', 'int32', 'i'),
+        ('timestamp', 'float64', 'd'),
+        ('owner', 'int8', 'b'),
+    )
+
+    def __init__(self, rows):
+        self.height = len(rows)
+        self.width = len(rows[0])
+        self.chars = [] # code -> char
+        self.codes = {} # char -> code
+        flat = [t for row in rows for t in row]
+        values = {
+            'code': [self.code_of(t.char) for t in flat],
+            'is_solid': [t.is_solid for t in flat],
+            'tagged': [t.tagged for t in flat],
+            'claimed': [t.claimed for t in flat],
+            'gold_value': [t.gold_value for t in flat],
+            'gold_stored': [t.gold_stored for t in flat],
+            'progress': [t.progress for t in flat],
+            'timestamp': [t.timestamp for t in flat],
+            'owner': [t.owner for t in flat],
+        }
+        for name, dtype, _ in self.COLUMNS:
+            setattr(self, name, np.array(values[name], dtype=dtype))
+        self.creator_type = {i: t.creator_type for i, t in enumerate(flat) if t.creator_type is not None}
+
+    def code_of(self, char):
+        code = self.codes.get(char)
+        if code is None:
+            code = self.codes[char] = len(self.chars)
+            self.chars.append(char)
+        return code
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, y):
+        if y < 0: y += self.height
+        if not 0 <= y < self.height: raise IndexError(y)
+        return TileRow(self, y)
+
+    def __iter__(self):
+        for y in range(self.height):
+            yield TileRow(self, y)
+
+    def __getstate__(self):
+        # Columns go out as raw bytes, readable with or without NumPy
+        skip = {'codes'} | {name for name, _, _ in self.COLUMNS}
+        state = {k: v for k, v in self.__dict__.items() if k not in skip}
+        state['columns'] = {name: (typecode, getattr(self, name).tobytes()) for name, _, typecode in self.COLUMNS}
+        return state
+
+    def __setstate__(self, state):
+        columns = state.pop('columns')
+        self.__dict__.update(state)
+        self.codes = {char: code for code, char in enumerate(self.chars)}
+        for name, dtype, typecode in self.COLUMNS:
+            raw = columns[name][1]
+            if np is not None:
+                setattr(self, name, np.frombuffer(raw, dtype=dtype).copy())
+            else:
+                setattr(self, name, array.array(typecode, raw)) # Only good for to_tiles()
+
+    def to_tiles(self):
+        # Back to a list of rows of Tile objects
+        rows = []
+        for y in range(self.height):
+            row = []
+            for x in range(self.width):
+                i = y * self.width + x
+                t = Tile(self.chars[self.code[i]], x, y)
+                t.is_solid = bool(self.is_solid[i])
+                t.tagged = bool(self.tagged[i])
+                t.claimed = bool(self.claimed[i])
+                t.gold_value = int(self.gold_value[i])
+                t.gold_stored = int(self.gold_stored[i])
+                t.progress = int(self.progress[i])
+                t.timestamp = float(self.timestamp[i])
+                t.owner = int(self.owner[i])
+                t.creator_type = self.creator_type.get(i)
+                row.append(t)
+            rows.append(row)
+        return rows
+
+    # Whole-map queries
+
+    def counts(self):
+        # char -> number of tiles
+        found = np.bincount(self.code, minlength=len(self.chars))
+        return {char: int(n) for char, n in zip(self.chars, found) if n}
+
+    def total(self, name, char=None):
+        # Sum of a numeric column, optionally over tiles of one char only
+        column = getattr(self, name)
+        if char is not None:
+            code = self.codes.get(char)
+            if code is None: return 0
+            column = column[self.code == code]
+        return int(column.sum())
+
+    def mask(self, name, value=True):
+        # Tiles where a column equals value, as a BitPlanes layer
+        # (a big int with bit y * width + x set)
+        bits = np.packbits(getattr(self, name) == value, bitorder='little')
+        return int.from_bytes(bits.tobytes(), 'little')
+
+class SearchWorkspace:
+    # Scratch grids shared by the Map's grid searches (A*/JPS, flow fields,
+    # region and room floods, cluster costs), indexed y * width + x and
+    # allocated once. A tile's cost and parent only count when its stamp
+    # holds the current search's epoch, so nothing is cleared between
+    # searches. Only one search can use it at a time.
     def __init__(self, width, height):
+        n = width * height
+        self.epoch = 0
+        self.stamp = [0] * n  # Epoch in which the tile was reached
+        self.closed = [0] * n # Epoch in which the tile was expanded
+        self.cost = [0] * n
+        self.parent = [0] * n
+        self.queue = [0] * n  # BFS frontier; a tile enters at most once per search
+        self.unset = [-1] * n # Template for resetting per-tile result lists
+        self.heap = []
+
+    def begin(self):
+        # New search: everything stamped so far is stale
+        self.epoch += 1
+        self.heap.clear()
+        return self.epoch
+
+class PathFinder:
+    # A* / Jump Point Search over the map grid.
+    # Movement is 8-way (diagonals may cut corners, same as the old BFS).
+    # Only non-solid tiles can be entered, except the target itself
+    # (so creatures can path "into" a wall they want to dig).
+    def __init__(self, game_map):
+        self.map = game_map
+
+    def find_path(self, start_x, start_y, target_x, target_y, mode=PATH_ASTAR, limit=5000):
+        # Returns list of steps [(x, y), ...] excluding start, or None
+        m = self.map
+        if not (0 <= target_x < m.width and 0 <= target_y < m.height): return None
+        if (start_x, start_y) == (target_x, target_y): return None
+        if mode == PATH_JPS:
+            return self.jps(start_x, start_y, target_x, target_y, limit)
+        return self.astar(start_x, start_y, target_x, target_y, limit)
+
+    @staticmethod
+    def octile(x1, y1, x2, y2):
+        dx = abs(x1 - x2)
+        dy = abs(y1 - y2)
+        if dx > dy: return COST_STRAIGHT * dx + (COST_DIAGONAL - COST_STRAIGHT) * dy
+        return COST_STRAIGHT * dy + (COST_DIAGONAL - COST_STRAIGHT) * dx
+
+    def astar(self, start_x, start_y, target_x, target_y, limit=5000):
+        m = self.map
+        w, h = m.width, m.height
+        tiles = m.tiles
+        octile = self.octile
+        start = start_y * w + start_x
+        goal = target_y * w + target_x
+
+        ws = m.workspace
+        epoch = ws.begin()
+        stamp, closed, g_cost, parent, open_heap = ws.stamp, ws.closed, ws.cost, ws.parent, ws.heap
+        stamp[start] = epoch
+        g_cost[start] = 0
+        parent[start] = -1
+        open_heap.append((octile(start_x, start_y, target_x, target_y), 0, start))
+        steps = 0
+
+        while open_heap and steps < limit:
+            f, g, curr = heapq.heappop(open_heap)
+            if closed[curr] == epoch: continue
+            if curr == goal:
+                return self.build_path(parent, goal)
+            closed[curr] = epoch
+            steps += 1
+
+            cx, cy = curr % w, curr // w
+            for dx, dy in DIRECTIONS_8:
+                nx, ny = cx + dx, cy + dy
+                if not (0 <= nx < w and 0 <= ny < h): continue
+                n = ny * w + nx
+                if closed[n] == epoch: continue
+                if tiles[ny][nx].is_solid and n != goal: continue
+
+                ng = g + (COST_DIAGONAL if dx and dy else COST_STRAIGHT)
+                if stamp[n] != epoch or ng < g_cost[n]:
+                    stamp[n] = epoch
+                    g_cost[n] = ng
+                    parent[n] = curr
+                    heapq.heappush(open_heap, (ng + octile(nx, ny, target_x, target_y), ng, n))
+        return None
+
+    def build_path(self, parent, goal):
+        # Walk parent links back to the start, expanding straight/diagonal runs
+        w = self.map.width
+        nodes = []
+        curr = goal
+        while parent[curr] != -1:
+            nodes.append(curr)
+            curr = parent[curr]
+        nodes.append(curr)
+        nodes.reverse()
+
+        path = []
+        for a, b in zip(nodes, nodes[1:]):
+            ax, ay = a % w, a // w
+            bx, by = b % w, b // w
+            sx = (bx > ax) - (bx < ax)
+            sy = (by > ay) - (by < ay)
+            while (ax, ay) != (bx, by):
+                ax += sx
+                ay += sy
+                path.append((ax, ay))
+        return path
+
+    def jps(self, start_x, start_y, target_x, target_y, limit=5000):
+        m = self.map
+        w = m.width
+        octile = self.octile
+        start = start_y * w + start_x
+        goal = target_y * w + target_x
+
+        ws = m.workspace
+        epoch = ws.begin()
+        stamp, closed, g_cost, parent, open_heap = ws.stamp, ws.closed, ws.cost, ws.parent, ws.heap
+        stamp[start] = epoch
+        g_cost[start] = 0
+        parent[start] = -1
+        open_heap.append((octile(start_x, start_y, target_x, target_y), 0, start))
+        steps = 0
+
+        while open_heap and steps < limit:
+            f, g, curr = heapq.heappop(open_heap)
+            if closed[curr] == epoch: continue
+            if curr == goal:
+                return self.build_path(parent, goal)
+            closed[curr] = epoch
+            steps += 1
+
+            cx, cy = curr % w, curr // w
+            p = parent[curr]
+            for dx, dy in self.pruned_directions(cx, cy, p, target_x, target_y):
+                jp = self.jump(cx, cy, dx, dy, target_x, target_y)
+                if not jp: continue
+                jx, jy = jp
+                n = jy * w + jx
+                if closed[n] == epoch: continue
+                ng = g + octile(cx, cy, jx, jy)
+                if stamp[n] != epoch or ng < g_cost[n]:
+                    stamp[n] = epoch
+                    g_cost[n] = ng
+                    parent[n] = curr
+                    heapq.heappush(open_heap, (ng + octile(jx, jy, target_x, target_y), ng, n))
+        return None
+
+    def walkable(self, x, y, target_x, target_y):
+        m = self.map
+        if not (0 <= x < m.width and 0 <= y < m.height): return False
+        return not m.tiles[y][x].is_solid or (x == target_x and y == target_y)
+
+    def pruned_directions(self, x, y, p, target_x, target_y):
+        # Natural + forced neighbours for the direction we arrived from
+        if p == -1:
+            return DIRECTIONS_8
+        w = self.map.width
+        px, py = p % w, p // w
+        dx = (x > px) - (x < px)
+        dy = (y > py) - (y < py)
+        ok = self.walkable
+        dirs = []
+        if dx and dy:
+            dirs.append((dx, dy))
+            dirs.append((dx, 0))
+            dirs.append((0, dy))
+            if not ok(x - dx, y, target_x, target_y): dirs.append((-dx, dy))
+            if not ok(x, y - dy, target_x, target_y): dirs.append((dx, -dy))
+        elif dx:
+            dirs.append((dx, 0))
+            if not ok(x, y + 1, target_x, target_y): dirs.append((dx, 1))
+            if not ok(x, y - 1, target_x, target_y): dirs.append((dx, -1))
+        else:
+            dirs.append((0, dy))
+            if not ok(x + 1, y, target_x, target_y): dirs.append((1, dy))
+            if not ok(x - 1, y, target_x, target_y): dirs.append((-1, dy))
+        return dirs
+
+    def jump_straight(self, x, y, dx, dy, target_x, target_y):
+        ok = self.walkable
+        while True:
+            x += dx
+            y += dy
+            if not ok(x, y, target_x, target_y): return None
+            if x == target_x and y == target_y: return (x, y)
+            if dx:
+                if (not ok(x, y + 1, target_x, target_y) and ok(x + dx, y + 1, target_x, target_y)) or \
+                   (not ok(x, y - 1, target_x, target_y) and ok(x + dx, y - 1, target_x, target_y)):
+                    return (x, y)
+            else:
+                if (not ok(x + 1, y, target_x, target_y) and ok(x + 1, y + dy, target_x, target_y)) or \
+                   (not ok(x - 1, y, target_x, target_y) and ok(x - 1, y + dy, target_x, target_y)):
+                    return (x, y)
+
+    def jump(self, x, y, dx, dy, target_x, target_y):
+        if not (dx and dy):
+            return self.jump_straight(x, y, dx, dy, target_x, target_y)
+        ok = self.walkable
+        while True:
+            x += dx
+            y += dy
+            if not ok(x, y, target_x, target_y): return None
+            if x == target_x and y == target_y: return (x, y)
+            # Forced neighbours on a diagonal
+            if (not ok(x - dx, y, target_x, target_y) and ok(x - dx, y + dy, target_x, target_y)) or \
+               (not ok(x, y - dy, target_x, target_y) and ok(x + dx, y - dy, target_x, target_y)):
+                return (x, y)
+            # Any straight jump point from here makes this a jump point
+            if self.jump_straight(x, y, dx, 0, target_x, target_y) or self.jump_straight(x, y, 0, dy, target_x, target_y):
+                return (x, y)
+
+class FlowField:
+    # Multi-source BFS distance grid towards a set of goal tiles.
+    # Every creature heading for the same place reads its next step from here
+    # instead of running its own search. Newly dug tiles are patched in
+    # place; a tile turning solid marks the whole field stale.
+    def __init__(self, game_map):
+        self.map = game_map
+        self.stamp = None # Goal-set version the field was built for
+        self.stale = True
+        self.dist = []
+        self.origin = []
+
+    def rebuild(self, goals, stamp):
+        m = self.map
+        w, h = m.width, m.height
+        tiles = m.tiles
+        ws = m.workspace
+        ws.begin()
+        # Refill the old grids in place rather than allocating new ones
+        dist, origin = self.dist, self.origin
+        if len(dist) != w * h:
+            dist, origin = list(ws.unset), list(ws.unset)
+        else:
+            dist[:] = ws.unset
+            origin[:] = ws.unset
+        queue = ws.queue
+        head = tail = 0
+        for gx, gy in goals:
+            i = gy * w + gx
+            if dist[i] == -1:
+                dist[i] = 0
+                origin[i] = i
+                queue[tail] = i
+                tail += 1
+
+        while head < tail:
+            curr = queue[head]
+            head += 1
+            cx, cy = curr % w, curr // w
+            d = dist[curr] + 1
+            o = origin[curr]
+            for dx, dy in DIRECTIONS_8:
+                nx, ny = cx + dx, cy + dy
+                if 0 <= nx < w and 0 <= ny < h:
+                    n = ny * w + nx
+                    if dist[n] == -1 and not tiles[ny][nx].is_solid:
+                        dist[n] = d
+                        origin[n] = o
+                        queue[tail] = n
+                        tail += 1
+
+        self.dist = dist
+        self.origin = origin
+        self.stamp = stamp
+        self.stale = False
+
+    def opened(self, x, y):
+        # Distances can only shrink when a tile opens: spread outwards from it
+        if self.stale: return
+        m = self.map
+        w, h = m.width, m.height
+        tiles = m.tiles
+        dist, origin = self.dist, self.origin
+        i = y * w + x
+        best = -1
+        for dx, dy in DIRECTIONS_8:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < w and 0 <= ny < h:
+                d = dist[ny * w + nx]
+                if d != -1 and (best == -1 or d < dist[best]):
+                    best = ny * w + nx
+        if best == -1: return
+        if dist[i] != -1 and dist[i] <= dist[best] + 1: return
+        dist[i] = dist[best] + 1
+        origin[i] = origin[best]
+
+        # Single source, so every tile is improved (and queued) at most once
+        m.workspace.begin()
+        queue = m.workspace.queue
+        queue[0] = i
+        head, tail = 0, 1
+        while head < tail:
+            curr = queue[head]
+            head += 1
+            cx, cy = curr % w, curr // w
+            d = dist[curr] + 1
+            o = origin[curr]
+            for dx, dy in DIRECTIONS_8:
+                nx, ny = cx + dx, cy + dy
+                if 0 <= nx < w and 0 <= ny < h:
+                    n = ny * w + nx
+                    if (dist[n] == -1 or dist[n] > d) and not tiles[ny][nx].is_solid:
+                        dist[n] = d
+                        origin[n] = o
+                        queue[tail] = n
+                        tail += 1
+
+    def distance(self, x, y):
+        # Steps to the nearest goal, -1 if unreachable
+        return self.dist[y * self.map.width + x]
+
+    def goal(self, x, y):
+        # Nearest goal tile as (x, y), or None
+        w = self.map.width
+        o = self.origin[y * w + x]
+        if o == -1: return None
+        return (o % w, o // w)
+
+    def step(self, x, y):
+        # Neighbour one step closer to a goal (None if on a goal or unreachable)
+        w, h = self.map.width, self.map.height
+        dist = self.dist
+        d = dist[y * w + x]
+        if d <= 0: return None
+        for dx, dy in DIRECTIONS_8:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < w and 0 <= ny < h and dist[ny * w + nx] == d - 1:
+                return (nx, ny)
+        return None
+
+class Regions:
+    # Connected-component labels for walkable (non-solid) space, 8-connected
+    # like movement. Opening a tile merges labels (union-find); closing one
+    # only relabels when the 3x3 ring around it shows a possible split.
+    def __init__(self, game_map):
+        self.map = game_map
+        self.build()
+
+    def build(self):
+        m = self.map
+        w, h = m.width, m.height
+        self.label = [-1] * (w * h)
+        self.parent = []
+        for y in range(h):
+            for x in range(w):
+                if self.label[y * w + x] == -1 and not m.tiles[y][x].is_solid:
+                    self.flood(x, y, self.new_label())
+
+    def new_label(self):
+        self.parent.append(len(self.parent))
+        return len(self.parent) - 1
+
+    def find(self, a):
+        parent = self.parent
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def flood(self, x, y, lab):
+        # Stamp lab on every walkable tile connected to (x, y)
+        m = self.map
+        w, h = m.width, m.height
+        tiles = m.tiles
+        label = self.label
+        label[y * w + x] = lab
+        m.workspace.begin()
+        queue = m.workspace.queue
+        queue[0] = y * w + x
+        head, tail = 0, 1
+        while head < tail:
+            curr = queue[head]
+            head += 1
+            cx, cy = curr % w, curr // w
+            for dx, dy in DIRECTIONS_8:
+                nx, ny = cx + dx, cy + dy
+                if 0 <= nx < w and 0 <= ny < h:
+                    n = ny * w + nx
+                    if label[n] != lab and not tiles[ny][nx].is_solid:
+                        label[n] = lab
+                        queue[tail] = n
+                        tail += 1
+
+    def region(self, x, y):
+        # Canonical region id, -1 for solid tiles
+        lab = self.label[y * self.map.width + x]
+        if lab == -1: return -1
+        return self.find(lab)
+
+    def walkable_neighbours(self, x, y):
+        m = self.map
+        result = []
+        for dx, dy in DIRECTIONS_8:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < m.width and 0 <= ny < m.height and not m.tiles[ny][nx].is_solid:
+                result.append((nx, ny))
+        return result
+
+    def touching(self, x, y):
+        # Regions a creature at (x, y) can use: its own, or its neighbours' if it stands on solid
+        r = self.region(x, y)
+        if r != -1: return {r}
+        return set(self.region(nx, ny) for nx, ny in self.walkable_neighbours(x, y))
+
+    def opened(self, x, y):
+        roots = set(self.region(nx, ny) for nx, ny in self.walkable_neighbours(x, y))
+        if roots:
+            root = roots.pop()
+            for r in roots:
+                self.parent[r] = root
+        else:
+            root = self.new_label()
+        self.label[y * self.map.width + x] = root
+
+    def closed(self, x, y):
+        self.label[y * self.map.width + x] = -1
+        ring = self.walkable_neighbours(x, y)
+        if len(ring) <= 1: return
+
+        # Group the ring tiles by adjacency to each other (ignoring the centre).
+        # One group means every path through (x, y) can go around it.
+        groups = []
+        left = set(ring)
+        while left:
+            seed = left.pop()
+            group = [seed]
+            stack = [seed]
+            while stack:
+                cx, cy = stack.pop()
+                for other in list(left):
+                    if max(abs(other[0] - cx), abs(other[1] - cy)) == 1:
+                        left.discard(other)
+                        group.append(other)
+                        stack.append(other)
+            groups.append(group)
+        if len(groups) == 1: return
+
+        # Possible split: relabel each piece that is still unlabelled
+        w = self.map.width
+        fresh = set()
+        for group in groups:
+            gx, gy = group[0]
+            if self.label[gy * w + gx] in fresh: continue
+            lab = self.new_label()
+            fresh.add(lab)
+            self.flood(gx, gy, lab)
+
+    def reachable(self, start_x, start_y, target_x, target_y):
+        if max(abs(start_x - target_x), abs(start_y - target_y)) <= 1: return True
+        src = self.touching(start_x, start_y)
+        if not src: return False
+        # Solid targets (dig sites, the heart) are reached from any walkable neighbour
+        return not src.isdisjoint(self.touching(target_x, target_y))
+
+class PathCache:
+    # Shared LRU of found paths, keyed by (start, target, mode).
+    # Entries are only valid for the block_generation they were computed in;
+    # the first lookup after a tile turns solid drops everything. Tiles
+    # opening up can only make a stored path longer than needed, never
+    # blocked, so digging leaves the cache alone. Failed searches are not
+    # kept: digging can open a way, and that does not change the generation.
+    # Every tile on a stored path is registered too, so a creature following
+    # its route hits the cache on the following ticks.
+    MISS = object()
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (path, index of next step)
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def sync(self, generation):
+        if generation != self.generation:
+            if self.entries:
+                self.entries.clear()
+                self.invalidations += 1
+            self.generation = generation
+
+    def get_path(self, start, target, mode, generation):
+        # (path, index of next step) from start, or MISS
+        self.sync(generation)
+        entry = self.entries.get((start, target, mode))
+        if entry is None:
+            self.misses += 1
+            return self.MISS
+        self.entries.move_to_end((start, target, mode))
+        self.hits += 1
+        return entry
+
+    def put(self, start, target, mode, path, generation):
+        if not path: return
+        self.sync(generation)
+        entries = self.entries
+        entries[(start, target, mode)] = (path, 0)
+        entries.move_to_end((start, target, mode))
+        for i, node in enumerate(path[:-1]):
+            entries[(node, target, mode)] = (path, i + 1)
+            entries.move_to_end((node, target, mode))
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'entries': len(self.entries),
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+class Hierarchy:
+    # HPA*: the map is cut into CLUSTER_SIZE squares. Walkable openings on the
+    # border between two clusters become entrance nodes; inside a cluster the
+    # entrances are linked by precomputed walking costs. Long searches run on
+    # this small graph; Map.request_trip has the hops between the waypoints
+    # searched on real tiles.
+    # A walkability change only dirties its own cluster (and the borders
+    # it shares), which are rebuilt on the next query. Entrance-to-entrance
+    # costs are filled in lazily, the first time a search expands a node.
+    def __init__(self, game_map, cluster_size=CLUSTER_SIZE):
+        self.map = game_map
+        self.size = cluster_size
+        self.cw = (game_map.width + cluster_size - 1) // cluster_size
+        self.ch = (game_map.height + cluster_size - 1) // cluster_size
+        self.borders = {} # (c1, c2) -> [(tile in c1, tile in c2), ...]
+        self.links = {}   # node -> set of nodes across a border
+        self.nodes = {}   # cluster -> set of entrance nodes
+        self.intra = {}   # cluster -> {node: {node: cost}} (filled on demand)
+        self.dirty = set(range(self.cw * self.ch))
+
+    def cluster_of(self, x, y):
+        return (y // self.size) * self.cw + (x // self.size)
+
+    def bounds(self, c):
+        x0 = (c % self.cw) * self.size
+        y0 = (c // self.cw) * self.size
+        return x0, y0, min(x0 + self.size, self.map.width), min(y0 + self.size, self.map.height)
+
+    def mark_dirty(self, x, y):
+        self.dirty.add(self.cluster_of(x, y))
+
+    def cluster_borders(self, c):
+        cx, cy = c % self.cw, c // self.cw
+        result = []
+        if cx > 0: result.append((c - 1, c))
+        if cx < self.cw - 1: result.append((c, c + 1))
+        if cy > 0: result.append((c - self.cw, c))
+        if cy < self.ch - 1: result.append((c, c + self.cw))
+        return result
+
+    def build_border(self, c1, c2):
+        # Scan the shared edge for runs of open tile pairs. A tile whose
+        # straight neighbour across is solid can still cross diagonally.
+        m = self.map
+        w = m.width
+        tiles = m.tiles
+        x0, y0, x1, y1 = self.bounds(c1)
+        pairs = []
+        if c2 == c1 + 1:
+            cells = [((x1 - 1, y), [(x1, y)] + [(x1, y + d) for d in (-1, 1) if y0 <= y + d < y1]) for y in range(y0, y1)]
+        else:
+            cells = [((x, y1 - 1), [(x, y1)] + [(x + d, y1) for d in (-1, 1) if x0 <= x + d < x1]) for x in range(x0, x1)]
+
+        run = []
+        for cell in cells + [None]:
+            pair = None
+            if cell:
+                (ax, ay), across = cell
+                if not tiles[ay][ax].is_solid:
+                    for bx, by in across:
+                        if not tiles[by][bx].is_solid:
+                            pair = ((ax, ay), (bx, by))
+                            break
+            if pair:
+                run.append(pair)
+                continue
+            if run:
+                # Long openings get an entrance at each end, short ones in the middle
+                picks = [run[0], run[-1]] if len(run) >= 6 else [run[len(run) // 2]]
+                for (ax, ay), (bx, by) in picks:
+                    pairs.append((ay * w + ax, by * w + bx))
+                run = []
+        return pairs
+
+    def refresh(self):
+        if not self.dirty: return
+        borders = set()
+        for c in self.dirty:
+            borders.update(self.cluster_borders(c))
+
+        affected = set(self.dirty)
+        for key in borders:
+            for a, b in self.borders.get(key, []):
+                self.links.get(a, set()).discard(b)
+                self.links.get(b, set()).discard(a)
+            pairs = self.build_border(*key)
+            self.borders[key] = pairs
+            for a, b in pairs:
+                self.links.setdefault(a, set()).add(b)
+                self.links.setdefault(b, set()).add(a)
+            affected.update(key)
+
+        for c in affected:
+            self.nodes[c] = self.cluster_nodes(c)
+            self.intra[c] = {}
+        self.dirty.clear()
+
+    def cluster_nodes(self, c):
+        nodes = set()
+        for c1, c2 in self.cluster_borders(c):
+            for a, b in self.borders.get((c1, c2), []):
+                nodes.add(a if c1 == c else b)
+        return nodes
+
+    def node_edges(self, n):
+        # Costs from entrance n to the other entrances of its cluster
+        w = self.map.width
+        c = self.cluster_of(n % w, n // w)
+        edges = self.intra[c].get(n)
+        if edges is None:
+            edges = self.costs_within(c, n % w, n // w, self.nodes[c])
+            edges.pop(n, None)
+            self.intra[c][n] = edges
+        return edges
+
+    def costs_within(self, c, ox, oy, goals):
+        # Dijkstra from (ox, oy) that never leaves cluster c
+        m = self.map
+        w = m.width
+        tiles = m.tiles
+        x0, y0, x1, y1 = self.bounds(c)
+        origin = oy * w + ox
+        ws = m.workspace
+        epoch = ws.begin()
+        stamp, dist, heap = ws.stamp, ws.cost, ws.heap
+        stamp[origin] = epoch
+        dist[origin] = 0
+        found = {}
+        heap.append((0, origin))
+        left = len(goals)
+        while heap and left:
+            d, curr = heapq.heappop(heap)
+            if d > dist[curr]: continue
+            if curr in goals and curr not in found:
+                found[curr] = d
+                left -= 1
+            cx, cy = curr % w, curr // w
+            for dx, dy in DIRECTIONS_8:
+                nx, ny = cx + dx, cy + dy
+                if x0 <= nx < x1 and y0 <= ny < y1 and not tiles[ny][nx].is_solid:
+                    n = ny * w + nx
+                    nd = d + (COST_DIAGONAL if dx and dy else COST_STRAIGHT)
+                    if stamp[n] != epoch or nd < dist[n]:
+                        stamp[n] = epoch
+                        dist[n] = nd
+                        heapq.heappush(heap, (nd, n))
+        return found
+
+    def abstract_path(self, start_x, start_y, target_x, target_y):
+        # Waypoint tiles from start to target over the cluster graph, or None
+        self.refresh()
+        w = self.map.width
+        START, GOAL = -1, -2
+        sc = self.cluster_of(start_x, start_y)
+        tc = self.cluster_of(target_x, target_y)
+        start_edges = self.costs_within(sc, start_x, start_y, self.nodes.get(sc, ()))
+        goal_edges = self.costs_within(tc, target_x, target_y, self.nodes.get(tc, ()))
+        if not start_edges or not goal_edges: return None
+
+        def h(n):
+            if n == START: return PathFinder.octile(start_x, start_y, target_x, target_y)
+            return PathFinder.octile(n % w, n // w, target_x, target_y)
+
+        g_cost = {START: 0}
+        parent = {START: None}
+        closed = set()
+        heap = [(h(START), 0, START)]
+        while heap:
+            f, g, curr = heapq.heappop(heap)
+            if curr in closed: continue
+            if curr == GOAL:
+                route = []
+                while curr is not None:
+                    route.append(curr)
+                    curr = parent[curr]
+                route.reverse()
+                return [(n % w, n // w) for n in route[1:-1]] + [(target_x, target_y)]
+            closed.add(curr)
+
+            if curr == START:
+                nbrs = start_edges.items()
+            else:
+                nbrs = list(self.node_edges(curr).items())
+                for n in self.links.get(curr, ()):
+                    diagonal = n % w != curr % w and n // w != curr // w
+                    nbrs.append((n, COST_DIAGONAL if diagonal else COST_STRAIGHT))
+                if curr in goal_edges:
+                    nbrs.append((GOAL, goal_edges[curr]))
+            for n, cost in nbrs:
+                if n in closed: continue
+                ng = g + cost
+                if ng < g_cost.get(n, ng + 1):
+                    g_cost[n] = ng
+                    parent[n] = curr
+                    heapq.heappush(heap, (ng + (0 if n == GOAL else h(n)), ng, n))
+        return None
+
+class RoutePlan:
+    # A creature's route to one target, kept between ticks (D* Lite).
+    # The search runs backwards from the target, so as the creature walks
+    # the start just slides along already-settled tiles. Walkability changes
+    # are read from the Map's change log and only the touched tiles are
+    # re-evaluated instead of planning again from scratch.
+    INF = float('inf')
+
+    def __init__(self, game_map, target_x, target_y, limit=5000):
+        self.map = game_map
+        self.target = (target_x, target_y)
+        self.limit = limit
+        self.reset()
+
+    def reset(self):
+        m = self.map
+        tx, ty = self.target
+        self.goal = ty * m.width + tx
+        self.start = None
+        self.last = None
+        self.km = 0
+        self.g = {}
+        self.rhs = {self.goal: 0}
+        self.queued = {}
+        self.heap = []
+        self.generation = m.walk_generation
+        self.push(self.goal)
+
+    def __getstate__(self):
+        # Saves only keep the target; the search is redone after loading
+        return {'map': self.map, 'target': self.target, 'limit': self.limit}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset()
+
+    def h(self, a, b):
+        w = self.map.width
+        return PathFinder.octile(a % w, a // w, b % w, b // w)
+
+    def key(self, s):
+        k = min(self.g.get(s, self.INF), self.rhs.get(s, self.INF))
+        return (k + self.h(self.start if self.start is not None else s, s) + self.km, k)
+
+    def push(self, s):
+        k = self.key(s)
+        self.queued[s] = k
+        heapq.heappush(self.heap, (k, s))
+
+    def cost(self, u, v):
+        # Stepping from u onto v: any open tile, or the target itself
+        m = self.map
+        w = m.width
+        vx, vy = v % w, v // w
+        if m.tiles[vy][vx].is_solid and v != self.goal: return self.INF
+        return COST_DIAGONAL if (u % w != vx and u // w != vy) else COST_STRAIGHT
+
+    def neighbours(self, s):
+        m = self.map
+        w, h = m.width, m.height
+        x, y = s % w, s // w
+        for dx, dy in DIRECTIONS_8:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < w and 0 <= ny < h:
+                yield ny * w + nx
+
+    def update_vertex(self, u):
+        m = self.map
+        w = m.width
+        # Nobody walks through solid tiles, so only the start needs a value there
+        if u != self.goal and u != self.start and m.tiles[u // w][u % w].is_solid:
+            self.rhs.pop(u, None)
+        elif u != self.goal:
+            g = self.g
+            best = self.INF
+            for s in self.neighbours(u):
+                gs = g.get(s, self.INF)
+                if gs < best:
+                    c = gs + self.cost(u, s)
+                    if c < best: best = c
+            self.rhs[u] = best
+        self.queued.pop(u, None)
+        if self.g.get(u, self.INF) != self.rhs.get(u, self.INF):
+            self.push(u)
+
+    def compute(self):
+        g, rhs, queued, heap = self.g, self.rhs, self.queued, self.heap
+        start = self.start
+        steps = 0
+        while heap and steps < self.limit:
+            k_old, u = heap[0]
+            if queued.get(u) != k_old:
+                heapq.heappop(heap) # Stale entry
+                continue
+            if not (k_old < self.key(start) or rhs.get(start, self.INF) != g.get(start, self.INF)):
+                return True
+            heapq.heappop(heap)
+            del queued[u]
+            steps += 1
+            k_new = self.key(u)
+            if k_old < k_new:
+                self.push(u)
+            elif g.get(u, self.INF) > rhs.get(u, self.INF):
+                g[u] = rhs[u]
+                for p in self.neighbours(u):
+                    self.update_vertex(p)
+            else:
+                g[u] = self.INF
+                self.update_vertex(u)
+                for p in self.neighbours(u):
+                    self.update_vertex(p)
+        return rhs.get(start, self.INF) == g.get(start, self.INF)
+
+    def sync(self, x, y):
+        m = self.map
+        start = y * m.width + x
+        if self.start is None:
+            self.start = self.last = start
+            self.update_vertex(start)
+        elif start != self.start:
+            self.start = start
+            self.update_vertex(start)
+
+        if self.generation != m.walk_generation:
+            changes = m.walk_changes_since(self.generation)
+            if changes is None:
+                # Change log no longer reaches back this far
+                self.reset()
+                self.start = self.last = start
+                self.update_vertex(start)
+                return
+            self.km += self.h(self.last, self.start)
+            self.last = self.start
+            for cx, cy in changes:
+                c = cy * m.width + cx
+                self.update_vertex(c)
+                for n in self.neighbours(c):
+                    if n in self.rhs or n in self.g:
+                        self.update_vertex(n)
+            self.generation = m.walk_generation
+        elif self.last != self.start:
+            self.km += self.h(self.last, self.start)
+            self.last = self.start
+
+    def next_step(self, x, y):
+        # Next tile along the route from (x, y), None if there is none (yet)
+        if (x, y) == self.target: return None
+        self.sync(x, y)
+        if not self.compute(): return None
+        start = self.start
+        if self.g.get(start, self.INF) == self.INF: return None
+
+        g = self.g
+        best, best_cost = None, self.INF
+        for s in self.neighbours(start):
+            c = g.get(s, self.INF) + self.cost(start, s)
+            if c < best_cost:
+                best, best_cost = s, c
+        if best is None: return None
+        w = self.map.width
+        return (best % w, best // w)
+
+class WalkSnapshot:
+    # Read-only copy of the walkability grid, enough for PathFinder.
+    # Built from one byte per tile (1 = solid) so it is cheap to ship to workers.
+    def __init__(self, width, height, walk):
+        self.width = width
+        self.height = height
+        solid, floor = SnapshotCell(True), SnapshotCell(False)
+        self.tiles = [[solid if walk[y * width + x] else floor for x in range(width)] for y in range(height)]
+        self.workspace = SearchWorkspace(width, height)
+
+class SnapshotCell:
+    def __init__(self, is_solid):
+        self.is_solid = is_solid
+
+def solve_path_batch(width, height, walk, requests):
+    # Worker entry point: [(sx, sy, tx, ty, mode, limit), ...] -> [path or None, ...]
+    finder = PathFinder(WalkSnapshot(width, height, walk))
+    return [finder.find_path(sx, sy, tx, ty, mode, limit) for sx, sy, tx, ty, mode, limit in requests]
+
+class PathRequest:
+    # Future for a PathService search. The path is filled in on the tick
+    # after submit(); pos is where the remaining path starts and index the
+    # next step along it. A trip with waypoints is searched one hop at a
+    # time and the hops joined up.
+    def __init__(self, service, start, target, mode, waypoints=None, limit=5000):
+        self.service = service
+        self.start = start
+        self.target = target
+        self.mode = mode
+        self.waypoints = waypoints or [target]
+        self.limit = limit
+        self.generation = service.map.walk_generation
+        self.block_generation = service.map.block_generation
+        self.pos = start
+        self.index = 0
+        self.path = None
+        self.finished = False
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        return self.path
+
+    def __getstate__(self):
+        # Saved requests come back unsubmitted and are asked again
+        state = self.__dict__.copy()
+        state['service'] = None
+        state['finished'] = False
+        state['path'] = None
+        return state
+
+class PathService:
+    # Batched path searches. Requests submitted during a tick are solved
+    # together at flush() against a snapshot of the walkability grid - on a
+    # process pool when the batch is big enough - and handed out by
+    # collect() at the start of a later tick. collect() never waits: a
+    # batch still out on the pool is kept for the next tick and its
+    # creatures hold their position meanwhile. Long trips arrive already
+    # cut into short hops by the cluster graph (Map.request_trip), so each
+    # worker search stays within a couple of clusters.
+    pool = None # One ProcessPoolExecutor for the whole process, shared by every Map
+
+    def __init__(self, game_map, workers=None):
+        self.map = game_map
+        if workers is None:
+            workers = (os.cpu_count() or 1) - 1
+        self.workers = max(0, min(workers, PATH_WORKERS_MAX))
+        self.pending = []
+        self.running = [] # (requests, [futures] or [paths])
+        self.snapshot = None
+        self.snapshot_generation = -1
+
+    def submit(self, start, target, mode=None, waypoints=None, limit=5000):
+        req = PathRequest(self, start, target, mode or self.map.path_mode, waypoints, limit)
+        self.pending.append(req)
+        return req
+
+    def ready(self, start, target, path, index=0):
+        # Request answered on the spot (from the PathCache)
+        req = PathRequest(self, start, target, PATH_HPA)
+        req.path = path
+        req.index = index
+        req.finished = True
+        return req
+
+    def take_snapshot(self):
+        m = self.map
+        if self.snapshot_generation != m.walk_generation:
+            self.snapshot = bytes(1 if t.is_solid else 0 for row in m.tiles for t in row)
+            self.snapshot_generation = m.walk_generation
+        return self.snapshot
+
+    def flush(self):
+        # End of tick: send this tick's requests off
+        if not self.pending: return
+        m = self.map
+        reqs, self.pending = self.pending, []
+        walk = self.take_snapshot()
+        # Same hop asked twice in one tick is only searched once
+        jobs = list(OrderedDict.fromkeys(job for r in reqs for job in self.jobs(r)))
+
+        pool = self.get_pool() if len(jobs) >= PATH_BATCH_MIN else None
+        if pool:
+            size = -(-len(jobs) // self.workers)
+            chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+            parts = [(chunk, pool.submit(solve_path_batch, m.width, m.height, walk, chunk)) for chunk in chunks]
+        else:
+            parts = [(jobs, solve_path_batch(m.width, m.height, walk, jobs))]
+        self.running.append((reqs, walk, parts))
+
+    def jobs(self, req):
+        # One search per hop between the request's waypoints
+        sx, sy = req.start
+        for tx, ty in req.waypoints:
+            if (tx, ty) != (sx, sy):
+                yield (sx, sy, tx, ty, req.mode, req.limit)
+            sx, sy = tx, ty
+
+    def collect(self):
+        # Start of tick: hand finished results to their requests
+        m = self.map
+        running, self.running = self.running, []
+        for batch in running:
+            reqs, walk, parts = batch
+            if any(not isinstance(part, list) and not part.done() for _, part in parts):
+                self.running.append(batch) # Still being searched
+                continue
+            solved = {}
+            for chunk, part in parts:
+                if not isinstance(part, list):
+                    try:
+                        part = part.result()
+                    except Exception:
+                        # Worker died or failed (e.g. BrokenProcessPool): stop
+                        # using the pool and solve this chunk here instead
+                        PathService.shutdown()
+                        self.workers = 0
+                        part = solve_path_batch(m.width, m.height, walk, chunk)
+                solved.update(zip(chunk, part))
+            for req in reqs:
+                path = []
+                for job in self.jobs(req):
+                    hop = solved[job]
+                    if not hop:
+                        path = None
+                        break
+                    path.extend(hop)
+                req.path = path or None
+                req.finished = True
+                # Trips found against the current map are shared through the
+                # cache: any creature starting on this path can reuse it
+                if req.block_generation == m.block_generation:
+                    m.path_cache.put(req.start, req.target, PATH_HPA, req.path, req.block_generation)
+
+    def get_pool(self):
+        if not self.workers: return None
+        if PathService.pool is None:
+            try:
+                PathService.pool = ProcessPoolExecutor(max_workers=self.workers)
+            except (OSError, NotImplementedError):
+                self.workers = 0 # No process support here; solve in-process
+        return PathService.pool
+
+    def close(self):
+        # The map is going away: drop its searches (the pool stays up)
+        for reqs, walk, parts in self.running:
+            for chunk, part in parts:
+                if not isinstance(part, list):
+                    part.cancel()
+        self.running = []
+        self.pending = []
+
+    @staticmethod
+    def shutdown(wait=False):
+        # Stop the shared pool (on exit, or when it breaks)
+        if PathService.pool:
+            PathService.pool.shutdown(wait=wait, cancel_futures=True)
+            PathService.pool = None
+
+class TileBuckets:
+    # Set of (x, y) positions hashed into size x size buckets, so the nearest
+    # one can be found by searching rings of buckets outward from a point.
+    def __init__(self, width, height, size=8):
+        self.size = size
+        self.rings = max(width, height) // size + 1
+        self.buckets = {} # (bx, by) -> set of (x, y)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, pos):
+        bucket = self.buckets.get((pos[0] // self.size, pos[1] // self.size))
+        return bucket is not None and pos in bucket
+
+    def __iter__(self):
+        for bucket in self.buckets.values():
+            yield from bucket
+
+    def add(self, pos):
+        key = (pos[0] // self.size, pos[1] // self.size)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = set()
+        if pos not in bucket:
+            bucket.add(pos)
+            self.count += 1
+
+    def discard(self, pos):
+        key = (pos[0] // self.size, pos[1] // self.size)
+        bucket = self.buckets.get(key)
+        if bucket is not None and pos in bucket:
+            bucket.remove(pos)
+            self.count -= 1
+            if not bucket:
+                del self.buckets[key]
+
+    def nearest(self, x, y, accept=None):
+        # Closest position (Chebyshev distance, then row, then column) that accept(pos) allows
+        return self.nearest_each(x, y, {None: (self, accept)})[None]
+
+    @classmethod
+    def nearest_each(cls, x, y, searches):
+        # nearest() for several TileBuckets of the same bucket size in one
+        # walk over the rings. searches is {key: (buckets, accept)}; returns
+        # {key: position or None}. A key drops out of the walk once its best
+        # hit can no longer be beaten.
+        best = dict.fromkeys(searches)
+        best_key = {}
+        left = {key: search for key, search in searches.items() if search[0].count}
+        if not left: return best
+        size = next(iter(left.values()))[0].size
+        bx, by = x // size, y // size
+        for r in range(max(search[0].rings for search in left.values()) + 1):
+            # Everything in ring r is at least this far away
+            bound = (r - 1) * size + 1
+            for key in [key for key in left if best[key] and best_key[key][0] < bound]:
+                del left[key]
+            if not left: break
+            for cell in cls.ring(bx, by, r):
+                for key, (buckets, accept) in left.items():
+                    bucket = buckets.buckets.get(cell)
+                    if not bucket: continue
+                    found, found_key = best[key], best_key.get(key)
+                    for pos in bucket:
+                        k = (max(abs(pos[0] - x), abs(pos[1] - y)), pos[1], pos[0])
+                        if found and k >= found_key: continue
+                        if accept and not accept(pos): continue
+                        found, found_key = pos, k
+                    best[key], best_key[key] = found, found_key
+        return best
+
+    @staticmethod
+    def ring(bx, by, r):
+        if r == 0:
+            yield (bx, by)
+            return
+        for i in range(-r, r + 1):
+            yield (bx + i, by - r)
+            yield (bx + i, by + r)
+        for i in range(-r + 1, r):
+            yield (bx - r, by + i)
+            yield (bx + r, by + i)
+
+class ClaimFrontier:
+    # Unclaimed floor 4-adjacent to claimed territory - where claiming can
+    # spread next. Re-checked around tiles that get claimed, dug or repainted.
+    def __init__(self, game_map):
+        self.map = game_map
+        self.tiles = TileBuckets(game_map.width, game_map.height)
+        for y in range(game_map.height):
+            for x in range(game_map.width):
+                self.refresh(x, y)
+
+    def refresh(self, x, y):
+        m = self.map
+        if not (0 <= x < m.width and 0 <= y < m.height): return
+        if m.is_claimable(m.tiles[y][x]): self.tiles.add((x, y))
+        else: self.tiles.discard((x, y))
+
+    def around(self, x, y):
+        self.refresh(x, y)
+        for dx, dy in DIRECTIONS_4:
+            self.refresh(x + dx, y + dy)
+
+class FloorGold:
+    # Floor tiles holding dropped gold, for pickup lookups
+    def __init__(self, game_map):
+        self.map = game_map
+        self.tiles = TileBuckets(game_map.width, game_map.height)
+        for y in range(game_map.height):
+            for x in range(game_map.width):
+                self.refresh(x, y)
+
+    def refresh(self, x, y):
+        m = self.map
+        if m.has_dropped_gold(m.tiles[y][x]): self.tiles.add((x, y))
+        else: self.tiles.discard((x, y))
+
+BIT_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+
+class BitPlanes:
+    # Whole-map boolean layers as Python big ints, bit y * width + x:
+    # solid, tagged, claimed and one layer per tile char. With shifts
+    # for dilate/erode, map-wide questions like "solid tiles next to
+    # walkable space" or "3x3 training centers" are a few int operations.
+    def __init__(self, game_map):
+        self.map = game_map
+        w, h = game_map.width, game_map.height
+        self.width = w
+        self.full = (1 << (w * h)) - 1
+        left = sum(1 << (y * w) for y in range(h))
+        self.not_left = self.full & ~left # No bit in column 0
+        self.not_right = self.full & ~(left << (w - 1)) # No bit in the last column
+        self.solid = 0
+        self.tagged = 0
+        self.claimed = 0
+        self.chars = {} # char -> layer
+        self.char_at = [None] * (w * h)
+        if isinstance(game_map.tiles, TileStore):
+            self.load(game_map.tiles)
+        else:
+            self.build(game_map.tiles)
+
+    @staticmethod
+    def pack(flags):
+        # Bools in bit order -> layer, converted once ('0'/'1' digits, high bit first)
+        return int(bytes(flags).translate(BIT_DIGITS)[::-1] or b'0', 2)
+
+    def build(self, rows):
+        # Whole layers from Tile objects, one pass each
+        flat = [t for row in rows for t in row]
+        self.solid = self.pack(t.is_solid for t in flat)
+        self.tagged = self.pack(t.tagged for t in flat)
+        self.claimed = self.pack(t.claimed for t in flat)
+        self.char_at = [t.char for t in flat]
+        for char in set(self.char_at):
+            self.chars[char] = self.pack(c == char for c in self.char_at)
+
+    def load(self, store):
+        # Whole layers straight from the TileStore columns
+        self.solid = store.mask('is_solid')
+        self.tagged = store.mask('tagged')
+        self.claimed = store.mask('claimed')
+        for code, char in enumerate(store.chars):
+            bits = store.mask('code', code)
+            if bits: self.chars[char] = bits
+        self.char_at = [store.chars[code] for code in store.code.tolist()]
+
+    def refresh(self, x, y):
+        # Re-read one tile into every layer
+        tile = self.map.tiles[y][x]
+        i = y * self.width + x
+        bit = 1 << i
+        self.solid = self.solid | bit if tile.is_solid else self.solid & ~bit
+        self.tagged = self.tagged | bit if tile.tagged else self.tagged & ~bit
+        self.claimed = self.claimed | bit if tile.claimed else self.claimed & ~bit
+        old = self.char_at[i]
+        if old != tile.char:
+            if old is not None:
+                self.chars[old] &= ~bit
+            self.chars[tile.char] = self.chars.get(tile.char, 0) | bit
+            self.char_at[i] = tile.char
+
+    def layer(self, char):
+        return self.chars.get(char, 0)
+
+    def walkable(self):
+        return self.full & ~self.solid
+
+    def dilate(self, bits):
+        # Every bit plus its 8 neighbours
+        row = bits | ((bits << 1) & self.not_left) | ((bits >> 1) & self.not_right)
+        return (row | (row << self.width) | (row >> self.width)) & self.full
+
+    def erode(self, bits):
+        # Bits whose 8 neighbours are all set (nothing survives on the map edge)
+        return self.full & ~self.dilate(self.full & ~bits)
+
+    def positions(self, bits):
+        # (x, y) of set bits in row order
+        w = self.width
+        while bits:
+            low = bits & -bits
+            i = low.bit_length() - 1
+            yield (i % w, i // w)
+            bits ^= low
+
+    # Map-wide queries
+
+    def exposed(self):
+        # Solid tiles with a walkable tile among their 8 neighbours
+        return self.solid & self.dilate(self.walkable())
+
+    def reinforceable(self):
+        # Untagged soft rock touching walkable space (dirt walls)
+        return self.layer(TILES_SOFT_ROCK) & ~self.tagged & self.dilate(self.walkable())
+
+    def centers(self, char):
+        # Tiles of char whose 8 neighbours are all the same char
+        return self.erode(self.layer(char))
+
+class WallFrontier:
+    # Solid tiles touching walkable space (8-way), by kind (the tile char:
+    # soft rock, gold, gem, reinforced, ...). Only the tiles around a
+    # walkability or wall change are re-checked.
+    def __init__(self, game_map):
+        self.map = game_map
+        self.tiles = {} # (x, y) -> kind
+        self.kinds = {} # kind -> TileBuckets
+        for x, y in game_map.planes.positions(game_map.planes.exposed()):
+            self.refresh(x, y)
+
+    def refresh(self, x, y):
+        m = self.map
+        if not (0 <= x < m.width and 0 <= y < m.height): return
+        tile = m.tiles[y][x]
+        kind = None
+        if tile.is_solid:
+            for dx, dy in DIRECTIONS_8:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < m.width and 0 <= ny < m.height and not m.tiles[ny][nx].is_solid:
+                    kind = tile.char
+                    break
+        pos = (x, y)
+        old = self.tiles.get(pos)
+        if old == kind: return
+        if old is not None:
+            self.kinds[old].discard(pos)
+            del self.tiles[pos]
+        if kind is not None:
+            self.tiles[pos] = kind
+            buckets = self.kinds.get(kind)
+            if buckets is None:
+                buckets = self.kinds[kind] = TileBuckets(m.width, m.height)
+            buckets.add(pos)
+
+    def around(self, x, y):
+        # (x, y) was dug out or filled in
+        self.refresh(x, y)
+        for dx, dy in DIRECTIONS_8:
+            self.refresh(x + dx, y + dy)
+
+    def of_kind(self, kind):
+        buckets = self.kinds.get(kind)
+        if buckets is None:
+            buckets = self.kinds[kind] = TileBuckets(self.map.width, self.map.height)
+        return buckets
+
+class Census:
+    # Running tile counts: per char, claimed per owner and tagged per char.
+    # Each tile's last counted (char, claimed, owner, tagged) is remembered,
+    # so update(x, y) after any change just moves the difference.
+    def __init__(self, game_map):
+        self.map = game_map
+        self.chars = {}
+        self.claimed = {} # owner -> count
+        self.tagged = {} # char -> count
+        self.seen = [None] * (game_map.width * game_map.height)
+        for y in range(game_map.height):
+            for x in range(game_map.width):
+                self.update(x, y)
+
+    @staticmethod
+    def signature(tile):
+        return (tile.char, tile.claimed, tile.owner, tile.tagged)
+
+    def count(self, table, key, delta):
+        table[key] = table.get(key, 0) + delta
+
+    def update(self, x, y):
+        i = y * self.map.width + x
+        new = self.signature(self.map.tiles[y][x])
+        old = self.seen[i]
+        if old == new: return
+        for sig, delta in ((old, -1), (new, 1)):
+            if sig is None: continue
+            char, claimed, owner, tagged = sig
+            self.count(self.chars, char, delta)
+            if claimed: self.count(self.claimed, owner, delta)
+            if tagged: self.count(self.tagged, char, delta)
+        self.seen[i] = new
+
+    def verify(self):
+        # Debug: recount from scratch and compare
+        if isinstance(self.map.tiles, TileStore):
+            mine = {k: v for k, v in self.chars.items() if v}
+            assert mine == self.map.tiles.counts(), "Census chars out of step"
+        fresh = Census(self.map)
+        for name in ('chars', 'claimed', 'tagged'):
+            mine = {k: v for k, v in getattr(self, name).items() if v}
+            real = {k: v for k, v in getattr(fresh, name).items() if v}
+            assert mine == real, "Census %s out of step: %r != %r" % (name, mine, real)
+
+    def of_char(self, char):
+        if CENSUS_DEBUG: self.verify()
+        return self.chars.get(char, 0)
+
+    def claimed_by(self, owner=None):
+        # owner None = all claimed tiles
+        if CENSUS_DEBUG: self.verify()
+        if owner is None: return sum(self.claimed.values())
+        return self.claimed.get(owner, 0)
+
+    def tagged_of(self, char):
+        if CENSUS_DEBUG: self.verify()
+        return self.tagged.get(char, 0)
+
+class TreasuryLedger:
+    # Gold stored on treasury tiles. Keeps the tiles with free space (for
+    # deposits and the treasury flow field) and the tiles holding gold (a
+    # heap, drained in row order like the old scan) so deposits and
+    # withdrawals never walk the map.
+    def __init__(self, game_map):
+        self.map = game_map
+        self.stored = {} # (x, y) -> gold, every treasury tile
+        self.total = 0
+        self.free = TileBuckets(game_map.width, game_map.height)
+        self.has_gold = set()
+        self.heap = [] # (y, x) of tiles with gold; stale entries are skipped
+        for row in game_map.tiles:
+            for t in row:
+                if t.char == TILES_TREASURY:
+                    self.refresh(t.x, t.y)
+
+    def refresh(self, x, y):
+        # Re-read a tile after it was painted or its gold_stored set directly
+        tile = self.map.tiles[y][x]
+        pos = (x, y)
+        self.total -= self.stored.pop(pos, 0)
+        if tile.char == TILES_TREASURY:
+            self.stored[pos] = tile.gold_stored
+            self.total += tile.gold_stored
+        self.reindex(pos)
+
+    def reindex(self, pos):
+        gold = self.stored.get(pos)
+        has_space = gold is not None and gold < TREASURY_CAPACITY
+        if has_space != (pos in self.free):
+            if has_space: self.free.add(pos)
+            else: self.free.discard(pos)
+            self.map.treasury_generation += 1 # Treasury flow field goals changed
+        if gold:
+            if pos not in self.has_gold:
+                self.has_gold.add(pos)
+                heapq.heappush(self.heap, (pos[1], pos[0]))
+        else:
+            self.has_gold.discard(pos)
+
+    def space_at(self, x, y):
+        gold = self.stored.get((x, y))
+        if gold is None: return 0
+        return TREASURY_CAPACITY - gold
+
+    def deposit(self, x, y, amount):
+        # Returns how much fit
+        put = min(amount, self.space_at(x, y))
+        if put <= 0: return 0
+        self.map.tiles[y][x].gold_stored += put
+        self.stored[(x, y)] += put
+        self.total += put
+        self.reindex((x, y))
+        return put
+
+    def withdraw(self, amount):
+        # Drain tiles in row order; returns how much was taken
+        taken = 0
+        heap = self.heap
+        while taken < amount and heap:
+            y, x = heap[0]
+            if (x, y) not in self.has_gold:
+                heapq.heappop(heap)
+                continue
+            take = min(amount - taken, self.stored[(x, y)])
+            self.map.tiles[y][x].gold_stored -= take
+            self.stored[(x, y)] -= take
+            self.total -= take
+            taken += take
+            self.reindex((x, y))
+            if (x, y) not in self.has_gold:
+                heapq.heappop(heap)
+        return taken
+
+    def check(self, expected=None):
+        # Debug: indexes agree with the tiles (and with expected total, if given)
+        real = {(t.x, t.y): t.gold_stored for row in self.map.tiles for t in row if t.char == TILES_TREASURY}
+        assert self.stored == real, "Treasury ledger out of step with tiles"
+        assert self.total == sum(real.values()), "Treasury total %d != %d" % (self.total, sum(real.values()))
+        assert set(self.free) == {p for p, g in real.items() if g < TREASURY_CAPACITY}, "Treasury free index out of step"
+        assert self.has_gold == {p for p, g in real.items() if g > 0}, "Treasury gold index out of step"
+        if isinstance(self.map.tiles, TileStore):
+            assert self.total == self.map.tiles.total('gold_stored', TILES_TREASURY), "Treasury total out of step with tile store"
+        if expected is not None:
+            assert self.total == expected, "Treasury holds %d, expected %d" % (self.total, expected)
+
+class FacilityTiles:
+    # Lair, bed, farm and training tiles by char, for nearest lookups
+    KINDS = ('L', TILES_BED, TILES_FARM, TILES_TRAINING)
+
+    def __init__(self, game_map):
+        self.map = game_map
+        self.kinds = {k: TileBuckets(game_map.width, game_map.height) for k in self.KINDS}
+        self.at = {} # (x, y) -> kind
+        for y in range(game_map.height):
+            for x in range(game_map.width):
+                self.refresh(x, y)
+
+    def refresh(self, x, y):
+        char = self.map.tiles[y][x].char
+        kind = char if char in self.kinds else None
+        pos = (x, y)
+        old = self.at.get(pos)
+        if old == kind: return
+        if old is not None:
+            self.kinds[old].discard(pos)
+            del self.at[pos]
+        if kind is not None:
+            self.kinds[kind].add(pos)
+            self.at[pos] = kind
+
+    def of_kind(self, kind):
+        return self.kinds[kind]
+
+# Room type of each room tile char (beds belong to their lair)
+ROOM_KINDS = {
+    'L': 'Lair', TILES_BED: 'Lair',
+    TILES_TREASURY: 'Treasury',
+    TILES_TRAINING: 'Training Room',
+    TILES_FARM: 'Farm',
+    'P': 'Prison',
+}
+
+class Room:
+    # One connected (4-way) patch of same-type room tiles
+    def __init__(self, rid, kind):
+        self.id = rid
+        self.kind = kind
+        self.tiles = set() # (x, y)
+        self.bbox = None # (min_x, min_y, max_x, max_y)
+
+    @property
+    def size(self):
+        return len(self.tiles)
+
+    def grow(self, pos):
+        self.tiles.add(pos)
+        x, y = pos
+        if self.bbox is None:
+            self.bbox = (x, y, x, y)
+        else:
+            x1, y1, x2, y2 = self.bbox
+            self.bbox = (min(x1, x), min(y1, y), max(x2, x), max(y2, y))
+
+    def fit(self):
+        xs = [p[0] for p in self.tiles]
+        ys = [p[1] for p in self.tiles]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys)) if xs else None
+
+class RoomLabels:
+    # Rooms as labelled connected components of ROOM_KINDS tiles. Kept up
+    # to date one tile at a time: painting merges neighbouring rooms,
+    # overwriting re-checks only the room that lost the tile.
+    def __init__(self, game_map):
+        self.map = game_map
+        self.rooms = {} # room id -> Room
+        self.label = {} # (x, y) -> room id
+        self.areas = {} # kind -> tiles in all rooms of that kind
+        self.next_id = 0
+        for y in range(game_map.height):
+            for x in range(game_map.width):
+                self.refresh(x, y)
+
+    def refresh(self, x, y):
+        kind = ROOM_KINDS.get(self.map.tiles[y][x].char)
+        pos = (x, y)
+        rid = self.label.get(pos)
+        if rid is not None:
+            if self.rooms[rid].kind == kind: return
+            self.remove(pos)
+        if kind is not None:
+            self.add(pos, kind)
+
+    def neighbours(self, pos):
+        x, y = pos
+        return ((x, y - 1), (x - 1, y), (x + 1, y), (x, y + 1))
+
+    def add(self, pos, kind):
+        self.areas[kind] = self.areas.get(kind, 0) + 1
+        joined = []
+        for n in self.neighbours(pos):
+            rid = self.label.get(n)
+            if rid is not None and self.rooms[rid].kind == kind and self.rooms[rid] not in joined:
+                joined.append(self.rooms[rid])
+        if not joined:
+            room = Room(self.next_id, kind)
+            self.next_id += 1
+            self.rooms[room.id] = room
+        else:
+            # Merge everything into the biggest neighbour
+            joined.sort(key=lambda r: -r.size)
+            room = joined[0]
+            for other in joined[1:]:
+                for p in other.tiles:
+                    room.grow(p)
+                    self.label[p] = room.id
+                del self.rooms[other.id]
+        room.grow(pos)
+        self.label[pos] = room.id
+
+    def remove(self, pos):
+        room = self.rooms[self.label.pop(pos)]
+        self.areas[room.kind] -= 1
+        room.tiles.discard(pos)
+        if not room.tiles:
+            del self.rooms[room.id]
+            return
+        ends = [n for n in self.neighbours(pos) if n in room.tiles]
+        if len(ends) > 1:
+            # The tile may have been a bridge; flood from each side
+            w = self.map.width
+            ws = self.map.workspace
+            epoch = ws.begin()
+            self.flood(ends[0], room.tiles, epoch)
+            for n in ends[1:]:
+                if ws.stamp[n[1] * w + n[0]] == epoch: continue
+                count = self.flood(n, room.tiles, epoch)
+                split = Room(self.next_id, room.kind)
+                self.next_id += 1
+                self.rooms[split.id] = split
+                for k in range(count):
+                    i = ws.queue[k]
+                    p = (i % w, i // w)
+                    split.grow(p)
+                    self.label[p] = split.id
+                    room.tiles.discard(p)
+        x1, y1, x2, y2 = room.bbox
+        if pos[0] in (x1, x2) or pos[1] in (y1, y2) or len(ends) > 1:
+            room.fit()
+
+    def flood(self, start, tiles, epoch):
+        # Stamp the part of tiles connected to start with epoch; the part is
+        # left in workspace.queue[:count] and count returned
+        w = self.map.width
+        ws = self.map.workspace
+        stamp, queue = ws.stamp, ws.queue
+        i = start[1] * w + start[0]
+        stamp[i] = epoch
+        queue[0] = i
+        head, tail = 0, 1
+        while head < tail:
+            curr = queue[head]
+            head += 1
+            for n in self.neighbours((curr % w, curr // w)):
+                if n in tiles:
+                    j = n[1] * w + n[0]
+                    if stamp[j] != epoch:
+                        stamp[j] = epoch
+                        queue[tail] = j
+                        tail += 1
+        return tail
+
+    def at(self, x, y):
+        rid = self.label.get((x, y))
+        return self.rooms[rid] if rid is not None else None
+
+    def of_kind(self, kind):
+        return [r for r in self.rooms.values() if r.kind == kind]
+
+    def area(self, kind):
+        # Tiles in all rooms of a kind together
+        return self.areas.get(kind, 0)
+
+    def largest(self, kind):
+        # Size of the biggest room of a kind, 0 if there is none
+        return max((r.size for r in self.rooms.values() if r.kind == kind), default=0)
+
+class FacilityService:
+    # Bed ownership both ways, lair spots promised to a Go'barr on its way
+    # to build, and where the training dummies stand. Tile lookups go to
+    # the map's FacilityTiles.
+    def __init__(self, entities):
+        self.map = entities.map
+        self.bed_owner = entities.bed_ownership # (x, y) -> creature id (saved with the game)
+        self.bed_of = {cid: pos for pos, cid in self.bed_owner.items()}
+        self.reserved = {} # (x, y) -> creature id
+        self.reservation = {} # creature id -> (x, y)
+        self.dummies = {} # (x, y) -> creature id, in spawn order
+        for c in entities.creatures.of_type('DUMMY'):
+            self.dummies[(c.x, c.y)] = c.id
+
+    def bed(self, cid):
+        return self.bed_of.get(cid)
+
+    def assign_bed(self, pos, cid):
+        self.release(cid)
+        self.bed_owner[pos] = cid
+        self.bed_of[cid] = pos
+
+    def free_bed(self, cid):
+        # Creature gives up its bed; returns where it was
+        pos = self.bed_of.pop(cid, None)
+        if pos is not None:
+            del self.bed_owner[pos]
+        return pos
+
+    def reserve(self, pos, cid):
+        self.release(cid)
+        self.reserved[pos] = cid
+        self.reservation[cid] = pos
+
+    def release(self, cid):
+        pos = self.reservation.pop(cid, None)
+        if pos is not None:
+            del self.reserved[pos]
+
+    def free_lair_spots(self):
+        return max(0, self.map.census.of_char('L') - len(self.reserved))
+
+    def nearest_free_lair(self, x, y, cid):
+        taken = {pos for pos, owner in self.reserved.items() if owner != cid}
+        return self.map.find_nearest_bed_spot(x, y, exclude=taken)
+
+    def add_dummy(self, pos, cid):
+        self.dummies[pos] = cid
+
+    def is_dummy(self, pos):
+        return pos in self.dummies
+
+    def nearest_dummy(self, x, y):
+        best, best_dist = None, 0
+        for pos in self.dummies:
+            dist = abs(x - pos[0]) + abs(y - pos[1])
+            if best is None or dist < best_dist:
+                best, best_dist = pos, dist
+        return best
+
+class DigJobs:
+    # Live index of tagged solid tiles (dig jobs) for find_priority_job.
+    # Jobs touching walkable space sit in groups keyed by (timestamp, is_gold);
+    # a drag tags its whole rectangle with one timestamp, so a group holds
+    # one drag's rock or gold. The keys sit in a heap, so the best job is in
+    # the first group with a usable tile and only that group needs a
+    # distance check. Emptied groups leave the heap when they reach the top.
+    def __init__(self, game_map):
+        self.map = game_map
+        self.jobs = {} # (x, y) -> key, every tagged solid tile
+        self.groups = {} # key -> set of exposed (x, y)
+        self.order = [] # Heap of group keys, possibly including emptied ones
+        self.queued = set() # Keys in order
+        for row in game_map.tiles:
+            for t in row:
+                if t.tagged and t.is_solid:
+                    self.add(t)
+
+    @staticmethod
+    def key(tile):
+        return (tile.timestamp, 0 if tile.char == TILES_GOLD else 1)
+
+    def add(self, tile):
+        pos = (tile.x, tile.y)
+        self.remove(*pos) # Re-tagging moves it to the new timestamp
+        self.jobs[pos] = self.key(tile)
+        self.refresh(*pos)
+
+    def remove(self, x, y):
+        key = self.jobs.pop((x, y), None)
+        if key is not None:
+            self.hide((x, y), key)
+
+    def show(self, pos, key):
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = set()
+            if key not in self.queued:
+                self.queued.add(key)
+                heapq.heappush(self.order, key)
+        group.add(pos)
+
+    def hide(self, pos, key):
+        group = self.groups.get(key)
+        if group is None or pos not in group: return
+        group.discard(pos)
+        if not group:
+            del self.groups[key]
+            if len(self.order) > 2 * len(self.groups) + 16:
+                # Mostly emptied keys: rebuild rather than let the heap grow
+                self.order = list(self.groups)
+                heapq.heapify(self.order)
+                self.queued = set(self.groups)
+
+    def keys(self):
+        # Keys of non-empty groups, best first
+        order, groups = self.order, self.groups
+        while order and order[0] not in groups:
+            self.queued.discard(heapq.heappop(order))
+        if not order: return
+        yield order[0]
+        # Only reached when nothing in the best group can be used
+        for key in sorted(order)[1:]:
+            if key in groups: yield key
+
+    def refresh(self, x, y):
+        # Re-check whether job (x, y) touches walkable space
+        key = self.jobs.get((x, y))
+        if key is None: return
+        if self.map.is_exposed(x, y): self.show((x, y), key)
+        else: self.hide((x, y), key)
+
+    def walk_changed(self, x, y):
+        # (x, y) was dug out or filled in: it and its neighbours may change
+        tile = self.map.tiles[y][x]
+        if tile.is_solid and tile.tagged: self.add(tile)
+        else: self.remove(x, y)
+        for dx, dy in DIRECTIONS_8:
+            self.refresh(x + dx, y + dy)
+
+class Map:
+    def __init__(self, width, height, storage=None):
         self.width = width
         self.height = height
         self.tiles = []
         self.heart_pos = (0, 0)
         self.portal_pos = (0, 0)
+        self.path_mode = PATH_JPS
+        self.storage = storage or TILE_STORAGE
         self.generate()
+        self.pack_tiles()
+        self.build_indexes()
+
+    def pack_tiles(self):
+        # Put the tiles in the storage asked for, as far as NumPy allows;
+        # Tile object maps share their untouched deep rock
+        packed = isinstance(self.tiles, TileStore)
+        if self.storage == TILE_STORAGE_ARRAYS and np is not None and not packed:
+            self.tiles = TileStore(self.tiles)
+        elif packed and (np is None or self.storage != TILE_STORAGE_ARRAYS):
+            self.tiles = self.tiles.to_tiles()
+        if not isinstance(self.tiles, TileStore):
+            self.share_rock()
+
+    def share_rock(self):
+        # Untouched rock not next to walkable space becomes a SHARED_ROCK flyweight
+        for y in range(self.height):
+            row = self.tiles[y]
+            for x in range(self.width):
+                t = row[x]
+                shared = SHARED_ROCK.get(t.char)
+                if shared is None or t is shared or not shared.untouched(t): continue
+                exposed = False
+                for dx, dy in DIRECTIONS_8:
+                    nx, ny = x + dx, y + dy
+                    if 0 <= nx < self.width and 0 <= ny < self.height and not self.tiles[ny][nx].is_solid:
+                        exposed = True
+                        break
+                if not exposed:
+                    row[x] = shared
+
+    def own_tile(self, x, y):
+        # Copy-on-write: a shared rock cell gets its own Tile before it is changed
+        tile = self.tiles[y][x]
+        if isinstance(tile, SharedTile):
+            tile = self.tiles[y][x] = Tile(tile.char, x, y)
+        return tile
+
+    # Derived lookup structures. These are never pickled, they are rebuilt
+    # from the tiles after generate() and after loading a save.
+    DERIVED = ('workspace', 'pathfinder', 'flow_fields', 'regions', 'path_cache', 'hierarchy', 'walk_log', 'path_service', 'planes', 'walls', 'claims', 'floor_gold', 'census', 'treasury', 'facility_tiles', 'rooms', 'dig_jobs')
+
+    def build_indexes(self):
+        self.workspace = SearchWorkspace(self.width, self.height) # Scratch space for every grid search
+        self.pathfinder = PathFinder(self)
+        self.walk_generation = 0 # Bumped whenever any tile's is_solid changes
+        self.block_generation = 0 # Bumped whenever a tile turns solid
+        self.treasury_generation = 0 # Bumped when treasury tiles gain/lose free space
+        self.flow_fields = {}
+        self.regions = Regions(self)
+        self.path_cache = PathCache()
+        self.hierarchy = Hierarchy(self)
+        self.walk_log = deque(maxlen=512) # (generation, x, y) of recent set_solid changes
+        self.path_service = PathService(self)
+        self.planes = BitPlanes(self)
+        self.walls = WallFrontier(self) # Needs planes
+        self.claims = ClaimFrontier(self)
+        self.floor_gold = FloorGold(self)
+        self.census = Census(self)
+        self.treasury = TreasuryLedger(self)
+        self.facility_tiles = FacilityTiles(self)
+        self.rooms = RoomLabels(self)
+        self.dig_jobs = DigJobs(self) # Needs walls for exposure
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in self.DERIVED:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.path_mode = state.get('path_mode', PATH_JPS)
+        self.storage = state.get('storage', TILE_STORAGE_OBJECTS)
+        self.pack_tiles()
+        self.build_indexes()
 
     def generate(self):
         # 1. Fill with Soft Rock
@@ -132,7 +2416,7 @@ class Map:
                 break
         
         # 5. Generate Gold Veins
-        num_veins = 20
+        num_veins = max(20, self.width * self.height // 200) # Scale with map area
         for _ in range(num_veins):
              vx = random.randint(2, self.width - 3)
              vy = random.randint(2, self.height - 3)
@@ -207,247 +2491,226 @@ class Map:
             return self.tiles[y][x]
         return None
 
-    def get_path_step(self, start_x, start_y, target_x, target_y):
-        # BFS to find next step towards target
-        queue = [(start_x, start_y, [])]
-        visited = set([(start_x, start_y)])
-        
-        # Limit search depth to avoid lag if unreachable
-        steps = 0
-        limit = 5000
-        
-        while queue and steps < limit:
-            curr_x, curr_y, path = queue.pop(0)
-            steps += 1
-            
-            if curr_x == target_x and curr_y == target_y:
-                if path: return path[0]
-                return None
-            
-            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                nx, ny = curr_x + dx, curr_y + dy
-                
-                # Check bounds and walkability
-                # We can walk on Floor or the Target itself (even if wall, we want to go adjacent)
-                # Actually we need to walk on Floor. Memory of target is tricky.
-                # Basic BFS for movement: Can only enter non-solid tiles.
-                
-                if 0 <= nx < self.width and 0 <= ny < self.height:
-                    tile = self.tiles[ny][nx]
-                    if not tile.is_solid or (nx == target_x and ny == target_y):
-                        if (nx, ny) not in visited:
-                            visited.add((nx, ny))
-                            new_path = list(path)
-                            new_path.append((nx, ny))
-                            queue.append((nx, ny, new_path))
-        return None
+    def get_path_step(self, start_x, start_y, target_x, target_y, mode=None):
+        # Next step towards target (None if already there or unreachable)
+        if not self.regions.reachable(start_x, start_y, target_x, target_y):
+            return None
 
-    def is_exposed(self, x, y):
-        # Check 8 neighbors for non-solid
-        for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < self.width and 0 <= ny < self.height:
-                if not self.tiles[ny][nx].is_solid:
-                    return True
-        return False
+        # Heart and Portal trips share one flow field instead of searching
+        key = None
+        if (target_x, target_y) == self.heart_pos: key = FLOW_HEART
+        elif (target_x, target_y) == self.portal_pos: key = FLOW_PORTAL
+        if key:
+            step = self.get_flow_step(start_x, start_y, key)
+            if step or not self.tiles[start_y][start_x].is_solid:
+                return step
+            # Standing on a solid tile (e.g. a dummy spawned underneath) - search instead
 
-    def find_nearest_tagged(self, start_x, start_y, exclude=set()):
-        # BFS to find nearest tagged tile or Gold
-        queue = [(start_x, start_y)]
-        visited = set([(start_x, start_y)])
-        
-        while queue:
-            curr_x, curr_y = queue.pop(0)
-            
-            # Actual Loop
-            DIRECTIONS = [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]
-            for dx, dy in DIRECTIONS:
-                nx, ny = curr_x + dx, curr_y + dy
-                if 0 <= nx < self.width and 0 <= ny < self.height:
-                    tile = self.tiles[ny][nx]
-                    if tile.tagged and tile.is_solid and (nx, ny) not in exclude:
-                        # MUST be exposed to open air (or accessible)
-                        if self.is_exposed(nx, ny):
-                            return tile
-            
-                    if not tile.is_solid and (nx, ny) not in visited:
-                        visited.add((nx, ny))
-                        queue.append((nx, ny))
+        path = self.pathfinder.find_path(start_x, start_y, target_x, target_y, mode or self.path_mode, limit=self.width * self.height)
+        if path: return path[0]
         return None
 
-    def find_nearest_treasury_space(self, start_x, start_y):
-        queue = [(start_x, start_y)]
-        visited = set([(start_x, start_y)])
-        while queue:
-            curr_x, curr_y = queue.pop(0)
-            # Check if this tile is treasury with space
-            tile = self.tiles[curr_y][curr_x]
-            if tile.char == TILES_TREASURY and tile.gold_stored < 500:
-                return tile
-            
-            # BFS neighbors (walkable)
-            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                nx, ny = curr_x + dx, curr_y + dy
-                if 0 <= nx < self.width and 0 <= ny < self.height:
-                    nt = self.tiles[ny][nx]
-                    if not nt.is_solid and (nx, ny) not in visited:
-                         visited.add((nx, ny))
-                         queue.append((nx, ny))
+    def set_solid(self, x, y, solid):
+        # All walkability changes go through here so caches can invalidate
+        tile = self.tiles[y][x]
+        if tile.is_solid == solid: return
+        tile = self.own_tile(x, y)
+        tile.is_solid = solid
+        if not solid:
+            # Rock next to walkable space is read by position (walls, jobs)
+            for dx, dy in DIRECTIONS_8:
+                if 0 <= x + dx < self.width and 0 <= y + dy < self.height:
+                    self.own_tile(x + dx, y + dy)
+        self.walk_generation += 1
+        if solid: self.block_generation += 1
+        self.walk_log.append((self.walk_generation, x, y))
+        self.hierarchy.mark_dirty(x, y)
+        if solid:
+            self.regions.closed(x, y)
+        else:
+            self.regions.opened(x, y)
+        for field in self.flow_fields.values():
+            if solid: field.stale = True
+            else: field.opened(x, y)
+        self.planes.refresh(x, y)
+        self.walls.around(x, y)
+        self.claims.around(x, y)
+        self.floor_gold.refresh(x, y)
+        self.census.update(x, y)
+        self.dig_jobs.walk_changed(x, y)
+
+    def tile_changed(self, x, y):
+        # Call after changing a tile's char or dropped gold in place
+        # (reinforcing, room painting, dropping/picking up gold)
+        self.planes.refresh(x, y)
+        self.walls.refresh(x, y)
+        self.claims.refresh(x, y)
+        self.floor_gold.refresh(x, y)
+        self.census.update(x, y)
+        self.treasury.refresh(x, y)
+        self.facility_tiles.refresh(x, y)
+        self.rooms.refresh(x, y)
+
+    def set_claimed(self, x, y, claimed=True):
+        self.own_tile(x, y).claimed = claimed
+        self.planes.refresh(x, y)
+        self.claims.around(x, y)
+        self.census.update(x, y)
+
+    def set_tagged(self, x, y, tagged, timestamp=None):
+        # Tag/untag a tile for digging; keeps the job index in step
+        tile = self.own_tile(x, y)
+        tile.tagged = tagged
+        if timestamp is not None:
+            tile.timestamp = timestamp
+        if tagged and tile.is_solid:
+            self.dig_jobs.add(tile)
+        else:
+            self.dig_jobs.remove(x, y)
+        self.planes.refresh(x, y)
+        self.census.update(x, y)
+
+    def walk_changes_since(self, generation):
+        # Tiles whose walkability changed after generation (None if the log is too short)
+        if generation == self.walk_generation: return []
+        if not self.walk_log or self.walk_log[0][0] > generation + 1: return None
+        return [(x, y) for gen, x, y in self.walk_log if gen > generation]
+
+    def is_long_trip(self, start_x, start_y, target_x, target_y):
+        return max(abs(start_x - target_x), abs(start_y - target_y)) > 2 * self.hierarchy.size
+
+    def request_trip(self, start_x, start_y, target_x, target_y):
+        # Long trip: the cluster graph picks the waypoints here and only the
+        # hops between them (a cluster or two each) go to the path service
+        start, target = (start_x, start_y), (target_x, target_y)
+        cached = self.path_cache.get_path(start, target, PATH_HPA, self.block_generation)
+        if cached is not PathCache.MISS:
+            return self.path_service.ready(start, target, *cached)
+        waypoints = self.hierarchy.abstract_path(start_x, start_y, target_x, target_y)
+        if waypoints:
+            # A border crossing is one step; fold it into the hop after it
+            waypoints = [a for a, b in zip(waypoints, waypoints[1:]) if max(abs(a[0] - b[0]), abs(a[1] - b[1])) > 1] + waypoints[-1:]
+            return self.path_service.submit(start, target, PATH_ASTAR, waypoints, limit=(3 * self.hierarchy.size) ** 2)
+        # Openings that only touch at a cluster corner have no entrance; search flat
+        return self.path_service.submit(start, target, self.path_mode, limit=self.width * self.height)
+
+    def is_reachable(self, start_x, start_y, target_x, target_y):
+        # O(1) label comparison, no search
+        return self.regions.reachable(start_x, start_y, target_x, target_y)
+
+    def flow_goals(self, key):
+        if key == FLOW_HEART: return [self.heart_pos]
+        if key == FLOW_PORTAL: return [self.portal_pos]
+        if key == FLOW_TREASURY:
+            return sorted(self.treasury.free, key=lambda p: (p[1], p[0]))
+        return []
+
+    def get_flow_field(self, key):
+        # Lazily rebuilt: at most one BFS per destination after a tile turns solid
+        stamp = self.treasury_generation if key == FLOW_TREASURY else 0
+        field = self.flow_fields.get(key)
+        if field is None:
+            field = FlowField(self)
+            self.flow_fields[key] = field
+        if field.stale or field.stamp != stamp:
+            field.rebuild(self.flow_goals(key), stamp)
+        return field
+
+    def get_flow_step(self, x, y, key):
+        return self.get_flow_field(key).step(x, y)
+
+    def get_flow_goal(self, x, y, key):
+        return self.get_flow_field(key).goal(x, y)
+
+    def is_exposed(self, x, y):
+        # Solid tile with a non-solid tile among its 8 neighbors
+        return (x, y) in self.walls.tiles
+
+    def find_nearest_facility(self, start_x, start_y, kind, exclude=()):
+        # Nearest reachable walkable tile of a FacilityTiles kind
+        regions, tiles = self.regions, self.tiles
+        def accept(pos):
+            x, y = pos
+            return pos not in exclude and not tiles[y][x].is_solid and regions.reachable(start_x, start_y, x, y)
+        pos = self.facility_tiles.of_kind(kind).nearest(start_x, start_y, accept)
+        if pos: return tiles[pos[1]][pos[0]]
         return None
 
     def find_nearest_farm(self, start_x, start_y):
-        queue = [(start_x, start_y)]
-        visited = set([(start_x, start_y)])
-        while queue:
-            curr_x, curr_y = queue.pop(0)
-            # Check if this tile is Farm
-            tile = self.tiles[curr_y][curr_x]
-            if tile.char == TILES_FARM and not tile.is_solid:
-                return tile
-            
-            # BFS neighbors (walkable)
-            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                nx, ny = curr_x + dx, curr_y + dy
-                if 0 <= nx < self.width and 0 <= ny < self.height:
-                    nt = self.tiles[ny][nx]
-                    if not nt.is_solid and (nx, ny) not in visited:
-                         visited.add((nx, ny))
-                         queue.append((nx, ny))
-        return None
+        return self.find_nearest_facility(start_x, start_y, TILES_FARM)
     
     def any_tagged_gold(self):
         # Quick check if any gold is tagged
-        # Could optimize by tracking count
-        for row in self.tiles:
-            for t in row:
-                if t.tagged and t.char == TILES_GOLD:
-                    return True
-        return False
+        return self.census.tagged_of(TILES_GOLD) > 0
 
-    def find_nearest_reinforceable(self, start_x, start_y):
-        # BFS to find nearest Dirt Wall (Soft Rock adj to floor) NOT TAGGED
-        queue = [(start_x, start_y)]
-        visited = set([(start_x, start_y)])
-        
-        while queue:
-            curr_x, curr_y = queue.pop(0)
-            
-            # Check neighbors (8-way)
-            for dx in [-1, 0, 1]:
-                for dy in [-1, 0, 1]:
-                    if dx == 0 and dy == 0: continue
-                    nx, ny = curr_x + dx, curr_y + dy
-                    if 0 <= nx < self.width and 0 <= ny < self.height:
-                         # ... check logic
-                         pass # handled in loop below
-            
-            # Actual Loop
-            DIRECTIONS = [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]
-            for dx, dy in DIRECTIONS:
-                nx, ny = curr_x + dx, curr_y + dy
-                if 0 <= nx < self.width and 0 <= ny < self.height:
-                    tile = self.tiles[ny][nx]
-                    # Must be Soft Rock (Dirt Wall), Not Tagged
-                    # Must be Soft Rock (Dirt Wall), Not Tagged, AND NOT GOLD
-                    if tile.char == TILES_SOFT_ROCK and not tile.tagged and tile.char != TILES_GOLD:
-                         return tile
-            
-            # Continue
-            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                nx, ny = curr_x + dx, curr_y + dy
-                if 0 <= nx < self.width and 0 <= ny < self.height:
-                    tile = self.tiles[ny][nx]
-                    if not tile.is_solid and (nx, ny) not in visited:
-                        visited.add((nx, ny))
-                        queue.append((nx, ny))
-        return None
+    def find_jobs(self, start_x, start_y, excludes):
+        # Best open target of every job in excludes ({job: targets to skip})
+        # for an imp at (start_x, start_y), as {job: tile or None}. Pickup,
+        # claim and reinforce are nearest-first and share one walk over
+        # their bucket indexes; digging ranks by tag age first, so it is
+        # read from the dig job index.
+        searches = {job: self.job_search(job, start_x, start_y, exclude) for job, exclude in excludes.items() if job != JOB_DIG}
+        found = TileBuckets.nearest_each(start_x, start_y, searches)
+        jobs = {job: self.tiles[pos[1]][pos[0]] if pos else None for job, pos in found.items()}
+        if JOB_DIG in excludes:
+            jobs[JOB_DIG] = self.find_priority_job(start_x, start_y, excludes[JOB_DIG])
+        return jobs
+
+    def job_search(self, job, start_x, start_y, exclude):
+        # (TileBuckets, accept) for a nearest-first job
+        regions, tiles = self.regions, self.tiles
+        if job == JOB_REINFORCE:
+            # Dirt Wall (Soft Rock adj to floor) NOT TAGGED, next to space we can reach
+            src = regions.touching(start_x, start_y)
+            def accept(pos):
+                x, y = pos
+                return pos not in exclude and not tiles[y][x].tagged and not src.isdisjoint(regions.touching(x, y))
+            return self.walls.of_kind(TILES_SOFT_ROCK), accept
+        def accept(pos):
+            return pos not in exclude and regions.reachable(start_x, start_y, pos[0], pos[1])
+        if job == JOB_PICKUP: return self.floor_gold.tiles, accept
+        return self.claims.tiles, accept # JOB_CLAIM
 
     def find_priority_job(self, start_x, start_y, exclude=set()):
         # Find best job: Oldest Timestamp > Gold > Distance
-        candidates = []
-        
-        # Optimize iteration? Tagged list?
-        # For now, scan all.
-        for y in range(self.height):
-            for x in range(self.width):
-                t = self.tiles[y][x]
-                if t.tagged and t.is_solid and (x, y) not in exclude:
-                     # Check exposed
-                     if self.is_exposed(x, y):
-                         candidates.append(t)
-        
-        if not candidates: return None
-        
-        # Sort
-        # 1. Timestamp (Ascending)
-        # 2. Is Gold? (Yes=0, No=1) - So we sort by negation of "is gold" if we want Gold first? 
-        # Actually prompt says: "prioritize digging gold over dirt if the gold and dirt have the SAME timestamp"
-        # So secondary key is Type.
-        # But timestamps are floats, unlikely to be exactly equal.
-        # "roughly same timestamp" -> Drag action sets exact same time for batch.
-        # So exact equality works for drag batches.
-        
-        # 3. Distance
-        
-        def priority_key(t):
-            dist = max(abs(t.x - start_x), abs(t.y - start_y))
-            is_gold = 0 if t.char == TILES_GOLD else 1
-            return (t.timestamp, is_gold, dist)
-            
-        candidates.sort(key=priority_key)
-        return candidates[0]
-
-    def find_nearest_unclaimed(self, start_x, start_y, exclude=set()):
-        # BFS to find nearest unclaimed Floor
-        queue = [(start_x, start_y)]
-        visited = set([(start_x, start_y)])
-        
-        # Limit search?
-        while queue:
-            curr_x, curr_y = queue.pop(0)
-            
-            # Check neighbors
-            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                nx, ny = curr_x + dx, curr_y + dy
-                if 0 <= nx < self.width and 0 <= ny < self.height:
-                    tile = self.tiles[ny][nx]
-                    # Must be Floor, Not Solid, Not Claimed
-                    if tile.char == TILES_FLOOR and not tile.is_solid and not tile.claimed:
-                        # NEW REQUIREMENT: Must be adjacent to existing CLAIMED tile
-                        is_contiguous = False
-                        for cx, cy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                             tx, ty = nx + cx, ny + cy
-                             if 0 <= tx < self.width and 0 <= ty < self.height:
-                                 if self.tiles[ty][tx].claimed:
-                                     is_contiguous = True
-                                     break
-                        
-                        if is_contiguous:
-                             return tile
-                    
-                    if not tile.is_solid and (nx, ny) not in visited and (nx, ny) not in exclude:
-                        visited.add((nx, ny))
-                        queue.append((nx, ny))
-                        if len(visited) > 2500: break # Perf limit
-            
-            if len(visited) > 2500: break
+        # Only exposed jobs (touching space we can actually reach) count
+        jobs = self.dig_jobs
+        src = self.regions.touching(start_x, start_y)
+        for key in jobs.keys():
+            best, best_dist = None, 0
+            for x, y in jobs.groups[key]:
+                if (x, y) in exclude: continue
+                dist = max(abs(x - start_x), abs(y - start_y))
+                if best and (dist, y, x) >= best_dist: continue
+                if src.isdisjoint(self.regions.touching(x, y)): continue
+                best, best_dist = (x, y), (dist, y, x)
+            if best:
+                return self.tiles[best[1]][best[0]]
         return None
 
-    def count_claimed(self):
-        count = 0
-        for y in range(self.height):
-             for x in range(self.width):
-                 if self.tiles[y][x].claimed:
-                     count += 1
-        return count
+    def find_nearest_bed_spot(self, start_x, start_y, exclude=()):
+        return self.find_nearest_facility(start_x, start_y, 'L', exclude)
+
+    def find_nearest_training_tile(self, start_x, start_y):
+        return self.find_nearest_facility(start_x, start_y, TILES_TRAINING)
+
+    def has_dropped_gold(self, tile):
+        return tile.char == TILES_FLOOR and tile.gold_value > 0 and not tile.is_solid
+
+    def is_claimable(self, tile):
+        # Unclaimed floor 4-adjacent to claimed territory
+        if tile.char != TILES_FLOOR or tile.is_solid or tile.claimed: return False
+        for dx, dy in DIRECTIONS_4:
+            nx, ny = tile.x + dx, tile.y + dy
+            if 0 <= nx < self.width and 0 <= ny < self.height and self.tiles[ny][nx].claimed:
+                return True
+        return False
+
+    def count_claimed(self, owner=None):
+        return self.census.claimed_by(owner)
 
     def count_room_tiles(self, tile_char):
-        count = 0
-        for row in self.tiles:
-            for t in row:
-                if t.char == tile_char:
-                    count += 1
-        return count
+        return self.census.of_char(tile_char)
     
     def is_valid_bed_spot(self, x, y):
         # Must be Lair ('L')
@@ -456,10 +2719,264 @@ class Map:
         if not tile or tile.char != 'L': return False
         return True
 
+class Creature:
+    # One creature. Writes to x/y are reported to the owning
+    # EntityManager's CreatureGrid and writes to target/state to its
+    # TargetTable, so both stay in step.
+    FIELDS = ('id', 'type', 'x', 'y', 'state', 'target', 'idle_timer', 'gold', 'work_timer', 'name',
+              'level', 'xp', 'health', 'max_health', 'damage', 'wage', 'happiness', 'hunger',
+              'unconscious', 'building_bed', 'route', 'trip')
+    __slots__ = FIELDS + ('table', 'grid')
+
+    def __init__(self, cid=0, c_type='IMP', x=0, y=0, name=''):
+        object.__setattr__(self, 'table', None)
+        object.__setattr__(self, 'grid', None)
+        self.id = cid
+        self.type = c_type
+        self.x = x
+        self.y = y
+        self.state = STATE_IDLE
+        self.target = None
+        self.idle_timer = 0
+        self.gold = 0
+        self.work_timer = 0
+        self.name = name
+        self.level = 1
+        self.xp = 0
+        self.health = 0
+        self.max_health = 0
+        self.damage = 0
+        self.wage = 0
+        self.happiness = 0
+        self.hunger = 0
+        self.unconscious = False
+        self.building_bed = False
+        self.route = None # RoutePlan towards the current target
+        self.trip = None # PathRequest for a long trip in flight
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name == 'x' or name == 'y':
+            if self.grid is not None:
+                self.grid.move(self)
+        elif name == 'target' or name == 'state':
+            if self.table is not None:
+                self.table.update(self)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in Creature.FIELDS)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict): return # Creature(dict) saves: fields came in through __setitem__
+        object.__setattr__(self, 'table', None)
+        object.__setattr__(self, 'grid', None)
+        for name, value in zip(Creature.FIELDS, state):
+            object.__setattr__(self, name, value)
+
+    def __setitem__(self, key, value):
+        # Loading saves from when creatures were dicts
+        try:
+            self.grid
+        except AttributeError:
+            Creature.__init__(self)
+        setattr(self, key, value)
+
+    @classmethod
+    def from_dict(cls, d):
+        c = cls()
+        for key, value in d.items():
+            if key in cls.FIELDS:
+                setattr(c, key, value)
+        if isinstance(c.state, str):
+            c.state = STATE_BY_NAME[c.state]
+        return c
+
+class CreatureRegistry:
+    # Every creature in spawn order, plus lookups by id and by type.
+    # remove() only marks a creature; it leaves the lists in flush() at
+    # the end of the tick, so a loop over the creatures never skips one.
+    def __init__(self, creatures=()):
+        self.all = []
+        self.by_id = {}
+        self.by_type = {} # type -> creatures of that type, in spawn order
+        self.leaving = []
+        for c in creatures:
+            self.add(c)
+
+    def __getstate__(self):
+        return {'all': self.all}
+
+    def __setstate__(self, state):
+        self.__init__(state['all'])
+
+    def __iter__(self):
+        return iter(self.all)
+
+    def __len__(self):
+        return len(self.all)
+
+    def add(self, c):
+        self.all.append(c)
+        self.by_id[c.id] = c
+        self.by_type.setdefault(c.type, []).append(c)
+
+    def remove(self, c):
+        self.leaving.append(c)
+
+    def flush(self):
+        if not self.leaving: return
+        gone = {c.id for c in self.leaving}
+        self.leaving = []
+        self.all = [c for c in self.all if c.id not in gone]
+        for cid in gone:
+            self.by_id.pop(cid, None)
+        for c_type, members in self.by_type.items():
+            self.by_type[c_type] = [c for c in members if c.id not in gone]
+
+    def get(self, cid):
+        return self.by_id.get(cid)
+
+    def of_type(self, c_type):
+        return self.by_type.get(c_type, [])
+
+class CreatureGrid:
+    # Creatures hashed into size x size buckets by position, for point,
+    # rectangle and radius queries. Results come back in spawn (id) order,
+    # the same order as EntityManager.creatures.
+    def __init__(self, size=8):
+        self.size = size
+        self.buckets = {} # (bx, by) -> {creature id: creature}
+        self.where = {} # creature id -> (bx, by)
+
+    def add(self, c):
+        c.grid = self
+        self.move(c)
+
+    def move(self, c):
+        key = (c.x // self.size, c.y // self.size)
+        old = self.where.get(c.id)
+        if old == key: return
+        if old is not None:
+            self.drop(old, c.id)
+        self.buckets.setdefault(key, {})[c.id] = c
+        self.where[c.id] = key
+
+    def remove(self, c):
+        old = self.where.pop(c.id, None)
+        if old is not None:
+            self.drop(old, c.id)
+        c.grid = None
+
+    def drop(self, key, cid):
+        bucket = self.buckets[key]
+        del bucket[cid]
+        if not bucket:
+            del self.buckets[key]
+
+    def in_rect(self, x1, y1, x2, y2):
+        # Creatures with x1 <= x <= x2 and y1 <= y <= y2
+        found = []
+        size = self.size
+        for by in range(y1 // size, y2 // size + 1):
+            for bx in range(x1 // size, x2 // size + 1):
+                bucket = self.buckets.get((bx, by))
+                if bucket:
+                    for c in bucket.values():
+                        if x1 <= c.x <= x2 and y1 <= c.y <= y2:
+                            found.append(c)
+        found.sort(key=lambda c: c.id)
+        return found
+
+    def at(self, x, y):
+        return self.in_rect(x, y, x, y)
+
+    def near(self, x, y, radius):
+        # Creatures within Chebyshev distance radius of (x, y)
+        return self.in_rect(x - radius, y - radius, x + radius, y + radius)
+
+class TargetTable:
+    # Which creatures are heading for which tile, with counts per job
+    # (TARGET_JOBS), so "is this taken" checks are dict lookups.
+    def __init__(self):
+        self.entries = {} # creature id -> (target, job)
+        self.holders = {} # target -> number of creatures on it
+        self.crowded = set() # targets with MAX_PER_TARGET or more creatures
+        self.jobs = {} # job -> {target: count}
+        self.workers = {} # job -> number of creatures on it
+
+    def track(self, c):
+        c.table = self
+        self.update(c)
+
+    def update(self, c):
+        target = c.target
+        new = (target, TARGET_JOBS.get(c.state)) if target else None
+        old = self.entries.get(c.id)
+        if old == new: return
+        if old: self.count(old, -1)
+        if new:
+            self.count(new, 1)
+            self.entries[c.id] = new
+        else:
+            del self.entries[c.id]
+
+    def remove(self, c):
+        old = self.entries.pop(c.id, None)
+        if old: self.count(old, -1)
+        c.table = None
+
+    def count(self, entry, delta):
+        target, job = entry
+        n = self.holders.get(target, 0) + delta
+        if n: self.holders[target] = n
+        else: del self.holders[target]
+        if n >= MAX_PER_TARGET: self.crowded.add(target)
+        else: self.crowded.discard(target)
+        if job:
+            targets = self.jobs.setdefault(job, {})
+            n = targets.get(target, 0) + delta
+            if n: targets[target] = n
+            else: del targets[target]
+            self.workers[job] = self.workers.get(job, 0) + delta
+
+    def taken(self, pos, cid):
+        # Someone other than creature cid is heading for pos
+        n = self.holders.get(pos, 0)
+        entry = self.entries.get(cid)
+        if entry and entry[0] == pos: n -= 1
+        return n > 0
+
+    def targets(self, job):
+        return self.jobs.get(job, {})
+
+    def working(self, job):
+        return self.workers.get(job, 0)
+
+class CreatureBehaviour:
+    # One creature type's entry in CREATURE_BEHAVIOURS, bound to an
+    # EntityManager: scorers and handlers are looked up once, and each
+    # phase becomes a list indexed by state.
+    def __init__(self, manager, spec):
+        self.desires = tuple((name, getattr(manager, DESIRE_SCORERS[name])) for name in spec['desires'])
+        self.hungry = spec['hungry']
+        self.phases = []
+        for phase in spec['phases']:
+            handlers = [None] * len(STATE_NAMES)
+            for state, name in phase.items():
+                if state == STATE_ANY:
+                    handlers = [getattr(manager, name)] * len(STATE_NAMES)
+            for state, name in phase.items():
+                if state != STATE_ANY:
+                    handlers[state] = getattr(manager, name)
+            self.phases.append(handlers)
+
 class EntityManager:
     def __init__(self, game_map):
         self.map = game_map
-        self.creatures = []
+        self.creatures = CreatureRegistry()
+        self.targets = TargetTable()
+        self.grid = CreatureGrid()
+        self.behaviours = self.bind_behaviours()
         self.ids = 0
         self.total_gold = 0 
         self.heart_gold = 0 # Track heart separately
@@ -469,29 +2986,48 @@ class EntityManager:
         self.spawn_timer = 0
         self.next_creature_type = 'IMP'
         self.bed_ownership = {} # (x,y) -> creature_id
+        self.facilities = FacilityService(self)
         
         # Spawn initial imps
         hx, hy = self.map.heart_pos
         for _ in range(4): # Spawn 4
             self.spawn_creature('IMP', hx, hy)
 
+    # Rebuilt after loading a save
+    DERIVED = ('targets', 'grid', 'behaviours')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in self.DERIVED:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not isinstance(self.creatures, CreatureRegistry): # Older saves: creatures were dicts
+            creatures = [c if isinstance(c, Creature) else Creature.from_dict(c) for c in self.creatures]
+            for c in creatures:
+                if isinstance(c.state, str):
+                    c.state = STATE_BY_NAME[c.state]
+            self.creatures = CreatureRegistry(creatures)
+        self.targets = TargetTable()
+        self.grid = CreatureGrid()
+        for c in self.creatures:
+            self.targets.track(c)
+            self.grid.add(c)
+        self.behaviours = self.bind_behaviours()
+        if 'facilities' not in state:
+            self.facilities = FacilityService(self)
+
+    def bind_behaviours(self):
+        return {c_type: CreatureBehaviour(self, spec) for c_type, spec in CREATURE_BEHAVIOURS.items()}
+
     def deduct_gold(self, amount):
         if self.total_gold < amount:
             return False
             
-        needed = amount
         # 1. Deduct from Treasuries first
-        for y in range(self.map.height):
-            for x in range(self.map.width):
-                tile = self.map.get_tile(x, y)
-                if tile and tile.char == TILES_TREASURY and tile.gold_stored > 0:
-                    take = min(needed, tile.gold_stored)
-                    tile.gold_stored -= take
-                    needed -= take
-                    if needed <= 0:
-                        break
-            if needed <= 0:
-                break
+        needed = amount - self.map.treasury.withdraw(amount)
                 
         # 2. Deduct from Heart last
         if needed > 0:
@@ -499,8 +3035,14 @@ class EntityManager:
             self.heart_gold -= take
             
         self.total_gold -= amount
+        self.check_gold()
         return True
 
+    def check_gold(self):
+        # Gold is either in the Heart or on treasury tiles
+        if LEDGER_DEBUG:
+            self.map.treasury.check(self.total_gold - self.heart_gold)
+
 
     def spawn_creature(self, c_type, x, y):
         # Added tick_offset to randomize updates or idle timing
@@ -510,47 +3052,77 @@ class EntityManager:
         name = random.choice(names_imp) if c_type == 'IMP' else random.choice(names_gobarr)
         
         # Base stats
-        c = {
-            'id': self.ids,
-            'type': c_type,
-            'x': x, 'y': y, 
-            'state': 'IDLE', 
-            'target': None, 
-            'idle_timer': 0,
-            'gold': 0,
-            'work_timer': 0, 
-            'name': name,
-            'level': 1,
-            'xp': 0,
-            'health': 0,
-            'max_health': 0,
-            'damage': 0,
-            'wage': 0,
-            'happiness': 0,
-            'hunger': 0,
-            'unconscious': False
-        }
+        c = Creature(self.ids, c_type, x, y, name)
         self.ids += 1
         
         if c_type == 'IMP':
-            c['max_health'] = 50
-            c['health'] = 50
-            c['damage'] = 5
-            c['wage'] = 0 # Imps don't get paid
+            c.max_health = 50
+            c.health = 50
+            c.damage = 5
+            c.wage = 0 # Imps don't get paid
         elif c_type == 'GOBARR':
-            c['max_health'] = 150
-            c['health'] = 150
-            c['damage'] = 30
-            c['wage'] = 5 # Starts at 5
+            c.max_health = 150
+            c.health = 150
+            c.damage = 30
+            c.wage = 5 # Starts at 5
         elif c_type == 'DUMMY':
-            c['max_health'] = 9999
-            c['health'] = 9999
-            c['damage'] = 0
-            c['wage'] = 0
-            c['state'] = 'STATIC'
-            c['name'] = "Dummy"
+            c.max_health = 9999
+            c.health = 9999
+            c.damage = 0
+            c.wage = 0
+            c.state = STATE_STATIC
+            c.name = "Dummy"
+            self.facilities.add_dummy((x, y), c.id)
         
-        self.creatures.append(c)
+        self.creatures.add(c)
+        self.targets.track(c)
+        self.grid.add(c)
+
+    def route_step(self, c, tx, ty):
+        # Next step along the creature's kept route to (tx, ty)
+        ix, iy = c.x, c.y
+        m = self.map
+        # Heart/Portal trips use the shared flow fields
+        if (tx, ty) in (m.heart_pos, m.portal_pos):
+            c.route = None
+            return m.get_path_step(ix, iy, tx, ty)
+        if not m.is_reachable(ix, iy, tx, ty):
+            c.route = None
+            return None
+        # Long trips: waypoints from the cluster graph, hops searched in the
+        # background by the path service, shared through the path cache
+        if m.is_long_trip(ix, iy, tx, ty):
+            c.route = None
+            return self.trip_step(c, tx, ty)
+
+        route = c.route
+        if route is None or route.target != (tx, ty) or route.map is not m:
+            route = RoutePlan(m, tx, ty)
+            c.route = route
+        return route.next_step(ix, iy)
+
+    def trip_step(self, c, tx, ty):
+        # Next step of a path service trip. While the search is out the
+        # creature holds its position (a step onto its own tile).
+        ix, iy = c.x, c.y
+        service = self.map.path_service
+        req = c.trip
+        if req is not None and req.done() and req.target == (tx, ty):
+            path = req.path
+            if path is None:
+                # No way there - unless the map changed since we asked
+                if req.generation == self.map.walk_generation: return None
+                req = None
+            elif req.index >= len(path) or req.pos != (ix, iy) or (self.map.get_tile(*path[req.index]).is_solid and path[req.index] != (tx, ty)):
+                req = None # Used up, moved off the plan, or the plan is now blocked
+            else:
+                req.pos = path[req.index]
+                req.index += 1
+                return req.pos
+        if req is None or req.target != (tx, ty) or req.service is not service:
+            req = self.map.request_trip(ix, iy, tx, ty)
+            c.trip = req
+        return (ix, iy)
 
     def get_level_threshold(self, level):
         # Starting level 1. Level 2 takes 10 xp.
@@ -572,22 +3144,25 @@ class EntityManager:
     def check_level_up(self, c):
         # While XP >= Threshold, Level Up
         # Capping at 10
-        while c['level'] < 10:
-             thresh = self.get_level_threshold(c['level'])
-             if c['xp'] >= thresh:
-                 c['xp'] -= thresh
-                 c['level'] += 1
+        while c.level < 10:
+             thresh = self.get_level_threshold(c.level)
+             if c.xp >= thresh:
+                 c.xp -= thresh
+                 c.level += 1
                  # Stat Up
-                 c['max_health'] += int(c['max_health'] * 0.1)
-                 c['health'] = c['max_health']
-                 c['damage'] += int(c['damage'] * 0.1)
-                 if c['type'] == 'GOBARR':
-                     c['wage'] += 1
+                 c.max_health += int(c.max_health * 0.1)
+                 c.health = c.max_health
+                 c.damage += int(c.damage * 0.1)
+                 if c.type == 'GOBARR':
+                     c.wage += 1
              else:
                  break
 
     def update(self):
         # 0. Global Logic
+
+        # Paths searched since last tick
+        self.map.path_service.collect()
         
         # Mana Generation
         claimed_count = self.map.count_claimed()
@@ -600,34 +3175,30 @@ class EntityManager:
             # Announce Payday? (Renderer can check self.payday_timer == 0 or similar state)
             # Trigger Wage Seeking
             for c in self.creatures:
-                if c['wage'] > 0 and c['state'] != 'UNCONSCIOUS':
-                    c['state'] = 'SEEKING_WAGE'
-                    c['target'] = None
+                if c.wage > 0 and c.state != STATE_UNCONSCIOUS:
+                    c.state = STATE_SEEKING_WAGE
+                    c.target = None
                     # Happiness penalty if they don't get paid will be handled when they fail?
                     # For now just reset status logic.
 
         # Spawn Go'barr Check
-        # Lair >= 10, Treasury >= 10, Portal exists. max 10 gobarrs.
-        gobarrs = [c for c in self.creatures if c['type'] == 'GOBARR']
+        # Lair >= 10, Treasury >= 10 (tiles in total), Portal exists. max 10 gobarrs.
+        gobarrs = self.creatures.of_type('GOBARR')
         
         self.spawn_timer -= 1
         
         if len(gobarrs) < 10 and self.spawn_timer <= 0:
              # Check Conditions
-             lair_size = self.map.count_room_tiles('L')
-             treasury_size = self.map.count_room_tiles(TILES_TREASURY)
+             # Built beds belong to their lair but never counted towards it
+             lair_size = self.map.rooms.area('Lair') - self.map.count_room_tiles(TILES_BED)
+             treasury_size = self.map.rooms.area('Treasury')
              
              if lair_size >= 10 and treasury_size >= 10:
                  has_space = False
                  # Limit 20 creatures
                  if len(self.creatures) < 20: 
-                      # Find valid bed spot to ensure cap isn't exceeded by space
-                      for y in range(self.map.height):
-                          for x in range(self.map.width):
-                              if self.map.is_valid_bed_spot(x, y):
-                                  has_space = True
-                                  break
-                          if has_space: break
+                      # Need a free bed spot to ensure cap isn't exceeded by space
+                      has_space = self.facilities.free_lair_spots() > 0
                  
                  if has_space:
                       px, py = self.map.portal_pos
@@ -636,978 +3207,722 @@ class EntityManager:
 
         # Logic update for creatures (1 tick per sec)
         for c in self.creatures:
-            ix, iy = c['x'], c['y']
-            
-            # 1. If currently working (Reinforcing or Mining)
-            # Validation of current target
-            target_valid = False
-            if c['target']:
-                 tx, ty = c['target']
-                 t_tile = self.map.get_tile(tx, ty)
-                 # If Digging/Mining: Tagged?
-                 if c['state'] == 'DIGGING':
-                     if t_tile and t_tile.tagged: target_valid = True
-                 # If Reinforcing: Soft Rock?
-                 elif c['state'] == 'REINFORCING':
-                     if t_tile and t_tile.char == TILES_SOFT_ROCK and not t_tile.tagged and t_tile.char != TILES_GOLD: target_valid = True
-                 # If Claiming: Not Claimed?
-                 elif c['state'] == 'CLAIMING':
-                     if t_tile and not t_tile.claimed and not t_tile.is_solid: target_valid = True
-            
-            if not target_valid and c['state'] not in ['RETURNING_GOLD', 'IDLE', 'UNCONSCIOUS', 'MOVING_PICKUP', 'MOVING_DIG', 'MOVING_REINFORCE', 'MOVING_CLAIM', 'SEEKING_WAGE', 'MOVING_EAT', 'EATING', 'CONSTRUCTING_BED', 'TRAINING', 'WANT_TRAIN', 'LEAVING', 'PATROLLING']:
-                c['target'] = None
-                c['state'] = 'IDLE'
-                c['work_timer'] = 0
-            
-            # State: UNCONSCIOUS
-            if c['health'] <= 0:
-                c['state'] = 'UNCONSCIOUS'
-                c['unconscious'] = True
-                # No actions. Other creatures drag them?
-                continue
-            
-            # Regen?
-            pass
-
-            # STATE TRANSITION LOGIC
-            
-            # STATE TRANSITION LOGIC (Weighted Priority)
-            
-            # Regen / Unconscious check
-            if c['state'] == 'UNCONSCIOUS':
-                if c['health'] < c['max_health']:
-                    c['health'] += 0.1 # Slow regen
-                else:
-                    c['state'] = 'IDLE' # Wake up
-                    c['unconscious'] = False
-                continue
+            self.tick(c)
 
-            # Calculate Desires
-            desires = []
-            
-            # 1. Survival: Eat
-            if c.get('hunger', 0) > 0 and c['type'] != 'IMP' and c['type'] != 'DUMMY':
-                score = c['hunger']
-                if score > 50: score += 20
-                if score > 80: score += 50
-                desires.append({'action': 'EAT', 'score': score})
-            
-            # 2. Greed: Wage
-            if c.get('wage', 0) > 0:
-                if c['state'] == 'SEEKING_WAGE':
-                    desires.append({'action': 'SEEK_WAGE', 'score': 90})
-            
-            # 3. Duty: Build Bed (Go'barr)
-            if c['type'] == 'GOBARR':
-                my_bed_pos = None
-                for pos, owner_id in self.bed_ownership.items():
-                    if owner_id == c['id']:
-                        my_bed_pos = pos
-                        break
-                if not my_bed_pos:
-                    desires.append({'action': 'BUILD_BED', 'score': 80})
-            
-            # 4. Improvement: Train
-            if c['type'] == 'GOBARR' and c['level'] < 4:
-                score = 40
-                if c.get('happiness', 0) > 5: score += 10
-                desires.append({'action': 'TRAIN', 'score': score})
-            
-            # 5. Work (Creatures)
-            if c['type'] == 'IMP':
-                desires.append({'action': 'WORK', 'score': 100})
-            
-            # 6. Patrol
-            if c['type'] == 'GOBARR':
-                desires.append({'action': 'PATROL', 'score': 15})
-            
-            # 7. Idle
-            desires.append({'action': 'IDLE', 'score': 10})
-            
-            desires.sort(key=lambda x: x['score'], reverse=True)
-            best = desires[0]
-            action = best['action']
-            
-            # State Switching
-            if action == 'EAT' and c['state'] != 'EATING' and c['state'] != 'MOVING_EAT':
-                target = self.map.find_nearest_farm(ix, iy)
-                if target:
-                    c['target'] = (target.x, target.y)
-                    c['state'] = 'MOVING_EAT'
-            
-            elif action == 'TRAIN' and c['state'] != 'TRAINING' and c['state'] != 'MOVING_TRAIN':
-                 c['state'] = 'WANT_TRAIN'
-            
-            elif action == 'SEEK_WAGE' and c['state'] != 'SEEKING_WAGE':
-                 c['state'] = 'SEEKING_WAGE'
+        # Imps left idle get their next jobs together
+        self.assign_jobs()
 
-            elif action == 'BUILD_BED' and c['state'] != 'CONSTRUCTING_BED':
-                # This will be handled by the CONSTRUCTING_BED state logic below
-                pass
-            
-            elif action == 'PATROL' and c['state'] != 'PATROLLING':
-                 c['state'] = 'PATROLLING'
-            
-            # EXECUTE STATE LOGIC
-            
-            # Hunger Update
-            if c['type'] != 'IMP' and c['type'] != 'DUMMY':
-                c['hunger'] = min(100, c.get('hunger', 0) + 0.5)
-
-            # 1. SEEKING_WAGE
-            if c['state'] == 'SEEKING_WAGE':
-                 if not c['target']:
-                      # Find nearest Treasury/Heart with gold > c['wage']
-                      # Simplified: Go to Heart preferably or Treasury.
-                      t = self.map.find_nearest_treasury_space(ix, iy)
-                      c['target'] = self.map.heart_pos
-                 
-                 tx, ty = c['target']
-                 dist = max(abs(ix - tx), abs(iy - ty))
-                 if dist <= 1:
-                     if self.deduct_gold(c['wage']):
-                         c['state'] = 'IDLE'
-                         c['target'] = None
-                     else:
-                         c['state'] = 'IDLE'
-                 else:
-                      path = self.map.get_path_step(ix, iy, tx, ty)
-                      if path: c['x'], c['y'] = path
-                 continue
-            
-            # 2. Bed Construction
-            if c['type'] == 'GOBARR' and c['state'] == 'IDLE':
-                my_bed_pos = None
-                for pos, owner_id in self.bed_ownership.items():
-                    if owner_id == c['id']:
-                        my_bed_pos = pos
+        # Spawn Dummies Check (End of Update)
+        # (only once some training room is big enough to hold a 3x3 block)
+        if self.payday_timer % 10 == 0 and self.map.rooms.largest('Training Room') >= 9:
+            # Centers of 3x3 training blocks, in row order
+            planes = self.map.planes
+            for x, y in planes.positions(planes.centers(TILES_TRAINING)):
+                has_dummy_nearby = False
+                for c in self.grid.near(x, y, 1):
+                    if c.type == 'DUMMY':
+                        has_dummy_nearby = True
                         break
                 
-                if not my_bed_pos:
-                    if not c.get('building_bed'):
-                        target_spot = None
-                        q = [(ix, iy)]
-                        visited = set([(ix, iy)])
-                        while q:
-                            cx, cy = q.pop(0)
-                            if self.map.is_valid_bed_spot(cx, cy):
-                                target_spot = (cx, cy)
-                                break
-                            if len(visited) > 2500: break
-                            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                                nx, ny = cx + dx, cy + dy
-                                if 0 <= nx < self.map.width and 0 <= ny < self.map.height:
-                                    if (nx, ny) not in visited and not self.map.tiles[ny][nx].is_solid:
-                                        visited.add((nx, ny))
-                                        q.append((nx, ny))
-                        
-                        if target_spot:
-                            c['target'] = target_spot
-                            c['state'] = 'CONSTRUCTING_BED'
-                    
-            if c['state'] == 'CONSTRUCTING_BED':
-                if not c['target']: 
-                    c['state'] = 'IDLE'
+                if not has_dummy_nearby:
+                    self.spawn_creature('DUMMY', x, y)
+                    self.map.set_solid(x, y, True)
+
+        # Creatures that left this tick drop out of the registry
+        self.creatures.flush()
+
+        # Searches asked for this tick run until the next one
+        self.map.path_service.flush()
+
+    def assign_jobs(self):
+        # Hand out work to every imp left idle this tick in one go. Job kinds
+        # are auctioned in priority order; they set off next tick.
+        idle = []
+        for imp in self.creatures.of_type('IMP'):
+            if imp.state != STATE_IDLE: continue
+            # Force Return if Full (but only if there is destination space!)
+            if imp.gold >= 300:
+                if self.heart_gold < 5000 or self.map.get_flow_goal(imp.x, imp.y, FLOW_TREASURY) is not None:
+                    imp.state = STATE_RETURNING_GOLD
                     continue
-                tx, ty = c['target']
-                if (ix, iy) == (tx, ty):
-                    tile = self.map.get_tile(ix, iy)
-                    if tile.char == 'L' and self.map.is_valid_bed_spot(ix, iy):
-                        tile.char = TILES_BED
-                        tile.creator_type = c['type']
-                        self.bed_ownership[(ix, iy)] = c['id']
-                    c['state'] = 'IDLE'
-                    c['target'] = None
-                else:
-                    path = self.map.get_path_step(ix, iy, tx, ty)
-                    if path: c['x'], c['y'] = path
-                    else: c['state'] = 'IDLE'
+            idle.append(imp)
+        if not idle: return
+
+        # 0. Pick up dropped gold (if not full)
+        # 1. Divide and conquer: one imp claims / reinforces if nobody else is
+        # 2. Digging based on job priority (oldest tag > gold > distance)
+        # 3. Claiming, then reinforcing, as general fallback work
+        rounds = [(JOB_PICKUP, 0)]
+        if self.targets.working(JOB_CLAIM) == 0: rounds.append((JOB_CLAIM, 1))
+        if self.targets.working(JOB_REINFORCE) == 0: rounds.append((JOB_REINFORCE, 1))
+        rounds += [(JOB_DIG, 0), (JOB_CLAIM, 0), (JOB_REINFORCE, 0)]
+
+        # One search per imp finds its best target of every kind up front.
+        # Hiring only ever closes targets, so a stale find is simply bid
+        # again when it comes up (see auction).
+        kinds = [JOB_PICKUP, JOB_CLAIM, JOB_REINFORCE, JOB_DIG]
+        found = {}
+        for imp in idle:
+            wanted = {job: self.job_exclude(job) for job in kinds if job != JOB_PICKUP or imp.gold < 300}
+            found[imp.id] = self.map.find_jobs(imp.x, imp.y, wanted)
+        for job, limit in rounds:
+            idle = self.auction(idle, job, limit, found)
+            if not idle: break
+
+    def auction(self, imps, job, limit=0, found=None):
+        # Greedy auction of one job kind: every imp bids on its best open
+        # target, the best bids win and outbid imps bid again on what is
+        # left, so the imp nearest a target gets it rather than the first in
+        # the list. limit caps how many imps are hired (0: no cap). found
+        # ({imp id: find_jobs result}) supplies the opening bids.
+        # Returns the imps still without work.
+        bids = []
+        for order, imp in enumerate(imps):
+            if found is not None:
+                bid = self.make_bid(imp, job, order, found[imp.id].get(job))
+            else:
+                bid = self.job_bid(imp, job, order)
+            if bid: bids.append(bid)
+        heapq.heapify(bids)
+
+        hired = set()
+        while bids and not (limit and len(hired) >= limit):
+            rank, order, pos = heapq.heappop(bids)
+            imp = imps[order]
+            if pos in self.job_exclude(job):
+                # Filled up by a better bid
+                bid = self.job_bid(imp, job, order)
+                if bid: heapq.heappush(bids, bid)
                 continue
+            imp.target = pos
+            imp.state = JOB_STATES[job] # DIGGING handles gold/rock itself
+            hired.add(order)
+        return [imp for order, imp in enumerate(imps) if order not in hired]
 
-            # 3. Training Logic
-            if c['state'] == 'WANT_TRAIN':
-                 # Target dummy first, otherwise any training tile
-                 dummies = [d for d in self.creatures if d['type'] == 'DUMMY']
-                 if dummies:
-                     dummies.sort(key=lambda d: abs(c['x']-d['x']) + abs(c['y']-d['y']))
-                     target = dummies[0]
-                     c['target'] = (target['x'], target['y'])
-                     c['state'] = 'TRAINING'
-                 else:
-                     # Fallback: Find a training room tile
-                     tx, ty = None, None
-                     q = [(ix, iy)]
-                     visited = set([(ix, iy)])
-                     while q:
-                         cx, cy = q.pop(0)
-                         tile = self.map.get_tile(cx, cy)
-                         if tile and tile.char == TILES_TRAINING:
-                             tx, ty = cx, cy
-                             break
-                         if len(visited) > 2500: break
-                         for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                             nx, ny = cx + dx, cy + dy
-                             if 0 <= nx < self.map.width and 0 <= ny < self.map.height:
-                                 if (nx, ny) not in visited and not self.map.tiles[ny][nx].is_solid:
-                                     visited.add((nx, ny))
-                                     q.append((nx, ny))
-                                     
-                     if tx is not None:
-                         c['target'] = (tx, ty)
-                         c['state'] = 'TRAINING'
-                     else:
-                         c['state'] = 'IDLE'
-
-            if c['state'] == 'TRAINING':
-                 if not c['target'] or c['level'] >= 4:
-                     c['state'] = 'IDLE'
-                     continue
-                     
-                 tx, ty = c['target']
-                 dist = max(abs(ix - tx), abs(iy - ty))
-                 target_tile = self.map.get_tile(tx, ty)
-                 
-                 # Check if target is a dummy or just a training room tile
-                 is_dummy = any(d['type'] == 'DUMMY' and d['x'] == tx and d['y'] == ty for d in self.creatures)
-                 valid_training_spot = dist <= 1 if is_dummy else (dist == 0) # Must stand on tile if no dummy
-                 
-                 if valid_training_spot:
-                     # Pay for training (1 gold per tick, roughly 10 per 10)
-                     if not self.deduct_gold(1):
-                         c['state'] = 'IDLE' # Can't afford
-                         # Optional: happiness decrease
-                         continue
-
-                     c['xp'] += 1
-                     self.check_level_up(c)
-                     
-                     moves = []
-                     for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                         nx, ny = ix + dx, iy + dy
-                         t = self.map.get_tile(nx, ny)
-                         if t and not t.is_solid and t.char == TILES_TRAINING:
-                             # Exclude dummy locations
-                             has_dummy = False
-                             for cre in self.creatures:
-                                 if cre['type'] == 'DUMMY' and cre['x'] == nx and cre['y'] == ny:
-                                     has_dummy = True
-                                     break
-                             if not has_dummy:
-                                 moves.append((nx, ny))
-                     
-                     if moves:
-                         nx, ny = random.choice(moves)
-                         c['x'], c['y'] = nx, ny
-                 else:
-                     path = self.map.get_path_step(ix, iy, tx, ty)
-                     if path: c['x'], c['y'] = path
-                     else: c['state'] = 'IDLE'
-                 continue
-            
-            # 4. Eating Logic
-            if c['state'] == 'MOVING_EAT':
-                 if not c['target']: 
-                     c['state'] = 'IDLE'
-                     continue
-                 tx, ty = c['target']
-                 if (ix, iy) == (tx, ty):
-                     c['state'] = 'EATING'
-                 else:
-                     path = self.map.get_path_step(ix, iy, tx, ty)
-                     if path: c['x'], c['y'] = path
-                     else: c['state'] = 'IDLE'
-                 continue
-            
-            if c['state'] == 'EATING':
-                 c['hunger'] -= 5
-                 if c['hunger'] <= 0:
-                     c['hunger'] = 0
-                     c['state'] = 'IDLE'
-                 continue
+    def job_exclude(self, job):
+        # Targets closed to another imp: MAX_PER_TARGET for digging and
+        # pickup, one imp per tile for claiming and reinforcing
+        if job in (JOB_CLAIM, JOB_REINFORCE):
+            return self.targets.targets(job)
+        return self.targets.crowded
+
+    def job_bid(self, imp, job, order):
+        # (rank, order, target) for imp's best open target of this job, or None
+        if job == JOB_PICKUP and imp.gold >= 300: return None
+        tile = self.map.find_jobs(imp.x, imp.y, {job: self.job_exclude(job)})[job]
+        return self.make_bid(imp, job, order, tile)
+
+    def make_bid(self, imp, job, order, tile):
+        if not tile: return None
+        x, y = imp.x, imp.y
+        rank = (max(abs(tile.x - x), abs(tile.y - y)), tile.y, tile.x)
+        if job == JOB_DIG:
+            rank = (DigJobs.key(tile), rank)
+        return (rank, order, (tile.x, tile.y))
 
+    def tick(self, c):
+        # One creature's turn: drop stale targets, weigh desires, then run
+        # its type's phases (see CREATURE_BEHAVIOURS)
+        if c.state in TARGET_CHECKS:
+            check = TARGET_CHECKS[c.state]
+            if check is None or not c.target or not getattr(self, check)(c.target):
+                c.target = None
+                c.state = STATE_IDLE
+                c.work_timer = 0
 
-            # 4. Imp Logic (Worker)
-            if c['type'] == 'IMP':
-                pass # Fallthrough to existing worker logic
+        if c.health <= 0:
+            c.state = STATE_UNCONSCIOUS
+            c.unconscious = True
+            # No actions. Other creatures drag them?
+            return
+
+        if c.state == STATE_UNCONSCIOUS:
+            if c.health < c.max_health:
+                c.health += 0.1 # Slow regen
             else:
-                if c['state'] == 'PATROLLING':
-                    if not c['target'] or (ix, iy) == c['target']:
-                        rx = random.randint(1, self.map.width - 2)
-                        ry = random.randint(1, self.map.height - 2)
-                        t = self.map.get_tile(rx, ry)
-                        if t and not t.is_solid:
-                            c['target'] = (rx, ry)
-                        else:
-                            c['state'] = 'IDLE' 
-                        continue
-                        
-                    tx, ty = c['target']
-                    path = self.map.get_path_step(ix, iy, tx, ty)
-                    if path: 
-                        c['x'], c['y'] = path
-                    else: 
-                        c['state'] = 'IDLE'
-                        c['target'] = None
-                continue  # Catch-all to prevent Go'barrs from running Imp logic
-
-            # --- ORIGINAL IMP LOGIC STARTS HERE (Refactored variable 'imp' to 'c') ---
-            imp = c # Alias for minimal code change
-            
-            # 1. If currently working (Reinforcing or Mining)
-            # Validation of current target
-            target_valid = False
-            if imp['target']:
-                 tx, ty = imp['target']
-                 t_tile = self.map.get_tile(tx, ty)
-                 # If Digging/Mining: Tagged?
-                 if imp['state'] == 'DIGGING':
-                     if t_tile and t_tile.tagged: target_valid = True
-                 # If Reinforcing: Soft Rock?
-                 elif imp['state'] == 'REINFORCING':
-                     if t_tile and t_tile.char == TILES_SOFT_ROCK and not t_tile.tagged and t_tile.char != TILES_GOLD: target_valid = True
-                 # If Claiming: Not Claimed?
-                 elif imp['state'] == 'CLAIMING':
-                     if t_tile and not t_tile.claimed and not t_tile.is_solid: target_valid = True
-            
-            
-            # STATE STICKINESS LOGIC
-            # If we are in the middle of a continuous work task, don't re-evaluate immediately unless done
-            stay_on_task = False
-            
-            if imp['state'] == 'RETURNING_GOLD' and imp['gold'] > 0:
-                stay_on_task = True
-            elif imp['state'] == 'MOVING_PICKUP':
-                stay_on_task = True
-                # Validate dropped gold is still there
-                if imp['target']:
-                    tx, ty = imp['target']
-                    t = self.map.get_tile(tx, ty)
-                    if not t or t.gold_value <= 0:
-                        stay_on_task = False
-            elif imp['state'] in ['MOVING_CLAIM', 'CLAIMING']:
-                # If we're claiming, try to find another adjacent claim instead of full re-eval
-                stay_on_task = True
-                if not imp['target'] and imp['state'] == 'CLAIMING':
-                     stay_on_task = False # Let it find a new one below
-            elif imp['state'] in ['MOVING_REINFORCE', 'REINFORCING']:
-                stay_on_task = True
-            elif imp['state'] in ['MOVING_DIG', 'DIGGING']:
-                stay_on_task = True
-            
-            if stay_on_task and target_valid:
-                pass # Stick to current state/target handled in Section 3
-            elif imp['state'] not in ['RETURNING_GOLD', 'IDLE', 'UNCONSCIOUS', 'MOVING_PICKUP', 'MOVING_DIG', 'MOVING_REINFORCE', 'MOVING_CLAIM', 'DIGGING', 'REINFORCING', 'CLAIMING']:
-                imp['target'] = None
-                imp['state'] = 'IDLE'
-                imp['work_timer'] = 0
-            
-            # Special case for continuous work: if we finish a single tile, we should immediately look for adjacent work of the same type
-            # so we stay "sticky" to the job type without going all the way back to IDLE logic, but if none adjacent, we drop to IDLE.
-            # This is handled mostly in the state execution for CLAIMING, etc.
+                c.state = STATE_IDLE # Wake up
+                c.unconscious = False
+            return
 
-            # 2. Look for work if Idle
-            if imp['state'] == 'IDLE':
-                # Check Priorities
-                
-                # Check 1: Force Return if Full (but only if there is destination space!)
-                if imp['gold'] >= 300:
-                    hx, hy = self.map.heart_pos
-                    space_exists = False
-                    if self.heart_gold < 5000:
-                        space_exists = True
-                    elif self.map.find_nearest_treasury_space(ix, iy) is not None:
-                        space_exists = True
-                    
-                    if space_exists:
-                        imp['state'] = 'RETURNING_GOLD'
-                        continue
-                
-                # Check 2: REMOVED "Return if carrying gold" to allow picking up dropped gold
-                # We only return if full, or if we explicitly decide to later.
-                
-                # Divide and Conquer: Filter targets taken by other imps
-                # But allowing picking up dropped gold
-                desired_dropped_gold = None
-                
-                # Check Priority 0: Pick up Dropped Gold (if not full)
-                if imp['gold'] < 300:
-                    # BFS for floor with gold > 0
-                    queue = [(ix, iy)]
-                    visited = set([(ix, iy)])
-                    while queue:
-                        cx, cy = queue.pop(0)
-                        t = self.map.get_tile(cx, cy)
-                        if t.char == TILES_FLOOR and t.gold_value > 0 and not t.is_solid: # Ensure valid floor
-                             desired_dropped_gold = (cx, cy)
-                             break
-                        
-                        # Limit search
-                        if len(visited) > 200: break
-                        
-                        for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                            nx, ny = cx + dx, cy + dy
-                            if 0 <= nx < self.map.width and 0 <= ny < self.map.height:
-                                if (nx, ny) not in visited:
-                                    visited.add((nx, ny))
-                                    queue.append((nx, ny))
-                
-                if desired_dropped_gold:
-                    imp['target'] = desired_dropped_gold
-                    imp['state'] = 'MOVING_PICKUP'
-                    
-                else: 
-                     # Priority 1: Digging/Mining (Tagged)
-                     # Density Limit Check
-                     # Max 3 imps per tile.
-                     # We must count how many imps target a specific tile.
-                     
-                     taken_counts = {}
-                     for other in self.creatures:
-                         if other['target']:
-                             t = other['target']
-                             taken_counts[t] = taken_counts.get(t, 0) + 1
-                     
-                     # We exclude targets that have >= 3 imps
-                     exclude_targets = set([t for t, count in taken_counts.items() if count >= 3])
-                     
-                     
-                     
-                     # Check Priority 1.5: Divide and Conquer
-                     
-                     # Check what other imps are doing
-                     claim_targets = set()
-                     reinforce_targets = set()
-                     pickup_targets = set()
-                     
-                     claiming_imps_count = 0
-                     reinforcing_imps_count = 0
-                     pickup_imps_count = 0
-                     
-                     for other in self.creatures:
-                         if other['target']:
-                             if other['state'] in ['MOVING_CLAIM', 'CLAIMING']:
-                                 claim_targets.add(other['target'])
-                                 claiming_imps_count += 1
-                             elif other['state'] in ['MOVING_REINFORCE', 'REINFORCING']:
-                                 reinforce_targets.add(other['target'])
-                                 reinforcing_imps_count += 1
-                             elif other['state'] == 'MOVING_PICKUP':
-                                 pickup_targets.add(other['target'])
-                                 pickup_imps_count += 1
-                                 
-                     target_tile = None
-                     
-                     # Need a pickup divider?
-                     if pickup_imps_count == 0 and imp['gold'] < 300:
-                         # Same BFS as above, but with exclude
-                         queue = [(ix, iy)]
-                         visited = set([(ix, iy)])
-                         while queue:
-                             cx, cy = queue.pop(0)
-                             t = self.map.get_tile(cx, cy)
-                             if t.char == TILES_FLOOR and t.gold_value > 0 and not t.is_solid and (cx, cy) not in pickup_targets:
-                                  target_tile = t
-                                  break
-                             if len(visited) > 200: break
-                             for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                                 nx, ny = cx + dx, cy + dy
-                                 if 0 <= nx < self.map.width and 0 <= ny < self.map.height:
-                                     if (nx, ny) not in visited:
-                                         visited.add((nx, ny))
-                                         queue.append((nx, ny))
-                         if target_tile:
-                             imp['target'] = (target_tile.x, target_tile.y)
-                             imp['state'] = 'MOVING_PICKUP'
-                     
-                     # Need a divider for claiming?
-                     if not target_tile and claiming_imps_count == 0:
-                          target_tile = self.map.find_nearest_unclaimed(ix, iy, exclude=claim_targets)
-                          if target_tile:
-                              imp['target'] = (target_tile.x, target_tile.y)
-                              imp['state'] = 'MOVING_CLAIM'
-                     
-                     # Need a divider for reinforcing?
-                     if not target_tile and reinforcing_imps_count == 0:
-                          target_tile = self.map.find_nearest_reinforceable(ix, iy)
-                          if target_tile and (target_tile.x, target_tile.y) not in reinforce_targets:
-                              imp['target'] = (target_tile.x, target_tile.y)
-                              imp['state'] = 'MOVING_REINFORCE'
-                     
-                     if not target_tile:
-                         # Priority 1: Digging/Reinforcing based on Job Priority
-                         target_tile = self.map.find_priority_job(ix, iy, exclude=exclude_targets)
-                         if target_tile:
-                             imp['target'] = (target_tile.x, target_tile.y)
-                             # Determine state based on tile
-                             # Tagged tiles are usually Digging (or Mining if gold)
-                             # Reset stats
-                             imp['state'] = 'MOVING_DIG' # Logic handles gold/rock in DIGGING state
-                         else:
-                              # Priority 2: Claiming (Unclaimed Floor) - Lower Priority
-                              # Divider logic didn't find one, but if we get here there are no dig jobs.
-                              # Just do standard claiming.
-                              target_tile = self.map.find_nearest_unclaimed(ix, iy, exclude=claim_targets)
-                              if target_tile:
-                                  imp['target'] = (target_tile.x, target_tile.y)
-                                  imp['state'] = 'MOVING_CLAIM'
-                              else:
-                                    # Priority 3: Reinforcing (Unvisited Dirt Walls) - Lowest?
-                                    # This is automatic work.
-                                    target_tile = self.map.find_nearest_reinforceable(ix, iy)
-                                    if target_tile:
-                                        imp['target'] = (target_tile.x, target_tile.y)
-                                        imp['state'] = 'MOVING_REINFORCE'
-            
-            # 3. Act based on State
-            if imp['state'] == 'RETURNING_GOLD':
-                # Logic: Deposit at Heart (limit 5000) or Treasury (500 per tile)
-                # First find target if none
-                if not imp['target']:
-                     hx, hy = self.map.heart_pos
-                     
-                     target_found = False
-                     
-                     # Check Heart First (if not full)
-                     if self.heart_gold < 5000:
-                         imp['target'] = (hx, hy)
-                         target_found = True
-                     
-                     # If Heart Full, check Treasury
-                     # Only if we aren't already targeting heart?
-                     if not target_found:
-                         t_tile = self.map.find_nearest_treasury_space(ix, iy)
-                         if t_tile:
-                             imp['target'] = (t_tile.x, t_tile.y)
-                             target_found = True
-                     
-                     # If both full?
-                     if not target_found:
-                         # Treasuries and Heart are full. Fall back to IDLE.
-                         imp['state'] = 'IDLE'
-                         imp['target'] = None
-                         continue
- 
-                
-                tx, ty = imp['target']
-                
-                # Move
-                # If target is Heart, we check adjacency
-                deposit_ready = False
-                t_tile_target = self.map.get_tile(tx, ty)
-                
-                if t_tile_target and t_tile_target.char == TILES_HEART:
-                    # Check dist
-                    dist = max(abs(ix - tx), abs(iy - ty))
-                    if dist <= 1:
-                        deposit_ready = True
-                else:
-                     if (ix, iy) == (tx, ty):
-                         deposit_ready = True
-                
-                if deposit_ready:
-                    # Deposit
-                    tile = t_tile_target # The target (Heart or Treasury)
-                    amount = imp['gold']
-                    deposit = 0
-                    
-                    if tile.char == TILES_HEART:
-                        space = 5000 - self.heart_gold
-                        deposit = min(amount, space)
-                        self.heart_gold += deposit
-                    elif tile.char == TILES_TREASURY:
-                        # Treasury tile hold 500
-                        space = 500 - tile.gold_stored
-                        deposit = min(amount, space)
-                        tile.gold_stored += deposit
-                    
-                    if deposit > 0:
-                        self.total_gold += deposit
-                        imp['gold'] -= deposit
-                        
-                    if imp['gold'] <= 0:
-                        imp['state'] = 'IDLE' # Done
-                        imp['target'] = None
-                    else:
-                        imp['target'] = None # Re-eval target next tick because maybe this tile is now full
-                else:
-                    next_pos = self.map.get_path_step(ix, iy, tx, ty)
-                    if next_pos:
-                        imp['x'], imp['y'] = next_pos
-            
-            # 3. Act based on State
-            if imp['state'] == 'MOVING_PICKUP':
-                if not imp['target']:
-                     imp['state'] = 'IDLE'
-                     continue
-                tx, ty = imp['target']
-                if (ix, iy) == (tx, ty):
-                    # Pickup
-                    t_tile = self.map.get_tile(ix, iy)
-                    if t_tile.gold_value > 0:
-                        space = 300 - imp['gold']
-                        pickup = min(space, t_tile.gold_value)
-                        imp['gold'] += pickup
-                        t_tile.gold_value -= pickup
-                        
-                        if t_tile.gold_value <= 0:
-                            t_tile.char = TILES_FLOOR # Reset char to floor if depleted
-                    
-                    found_next = False
-                    if imp['gold'] < 300:
-                         for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                             nx, ny = tx + dx, ty + dy
-                             if 0 <= nx < self.map.width and 0 <= ny < self.map.height:
-                                 nt = self.map.get_tile(nx, ny)
-                                 if nt and nt.char == TILES_FLOOR and nt.gold_value > 0 and not nt.is_solid:
-                                     taken = False
-                                     for other in self.creatures:
-                                         if other['id'] != imp['id'] and other['target'] == (nx, ny):
-                                             taken = True
-                                             break
-                                     if not taken:
-                                         imp['target'] = (nx, ny)
-                                         imp['state'] = 'MOVING_PICKUP'
-                                         found_next = True
-                                         break
-                    
-                    if not found_next:
-                        imp['target'] = None
-                        imp['state'] = 'IDLE'
-                else:
-                    path = self.map.get_path_step(ix, iy, tx, ty)
-                    if path: 
-                        imp['x'], imp['y'] = path
-                    else:
-                        imp['target'] = None # Unreachable
-                        imp['state'] = 'IDLE'
+        behaviour = self.behaviours[c.type]
+        switch = DESIRE_STATES.get(self.desire(c, behaviour.desires))
+        if switch and c.state not in switch[1]:
+            state = switch[0]
+            enter = STATE_ENTRY.get(state)
+            if enter is None or getattr(self, enter)(c):
+                c.state = state
 
-            elif imp['state'] == 'MOVING_DIG' or imp['state'] == 'MOVING_REINFORCE' or imp['state'] == 'MOVING_CLAIM':
-                if not imp['target']: 
-                    imp['state'] = 'IDLE' 
-                    continue
-                tx, ty = imp['target']
-                t_tile = self.map.get_tile(tx, ty)
-                
-                # Check adjacency (Chebyshev distance for diagonals)
-                dist_x = abs(ix - tx)
-                dist_y = abs(iy - ty)
-                dist = max(dist_x, dist_y)
-                if dist <= 1:
-                    # Start Working
-                    if imp['state'] == 'MOVING_DIG': 
-                        imp['state'] = 'DIGGING'
-                        imp['work_timer'] = 0
-                    elif imp['state'] == 'MOVING_REINFORCE': 
-                        imp['state'] = 'REINFORCING'
-                        imp['work_timer'] = 0
-                    elif imp['state'] == 'MOVING_CLAIM':
-                         # Claiming requires standing on top (dist == 0)
-                         if dist == 0:
-                             imp['state'] = 'CLAIMING'
-                             imp['work_timer'] = 0
-                         else:
-                             # Keep moving closer if adjacent
-                             path = self.map.get_path_step(ix, iy, tx, ty)
-                             if path: 
-                                 imp['x'], imp['y'] = path
+        if behaviour.hungry:
+            c.hunger = min(100, c.hunger + 0.5)
+
+        for phase in behaviour.phases:
+            handler = phase[c.state]
+            if handler is not None and handler(c):
+                return
+
+    def desire(self, c, desires):
+        # Highest scoring desire; the earlier one wins a tie
+        best, best_score = DESIRE_IDLE, None
+        for name, scorer in desires:
+            score = scorer(c)
+            if score is not None and (best_score is None or score > best_score):
+                best, best_score = name, score
+        return best
+
+    # Desire scorers (None: the desire doesn't apply)
+
+    def want_food(self, c):
+        if c.hunger <= 0:
+            return None
+        score = c.hunger
+        if score > 50: score += 20
+        if score > 80: score += 50
+        return score
+
+    def want_wage(self, c):
+        if c.wage > 0 and c.state == STATE_SEEKING_WAGE:
+            return 90
+        return None
+
+    def want_bed(self, c):
+        return None if self.facilities.bed(c.id) else 80
+
+    def want_training(self, c):
+        if c.level >= 4:
+            return None
+        return 50 if c.happiness > 5 else 40
+
+    def want_work(self, c):
+        return 100
+
+    def want_patrol(self, c):
+        return 15
+
+    def want_rest(self, c):
+        return 10
+
+    # Target checks (TARGET_CHECKS)
+
+    def can_dig(self, target):
+        t_tile = self.map.get_tile(*target)
+        return bool(t_tile and t_tile.tagged)
+
+    def can_reinforce(self, target):
+        t_tile = self.map.get_tile(*target)
+        return bool(t_tile and t_tile.char == TILES_SOFT_ROCK and not t_tile.tagged)
+
+    def can_claim(self, target):
+        t_tile = self.map.get_tile(*target)
+        return bool(t_tile and not t_tile.claimed and not t_tile.is_solid)
+
+    # State entry (STATE_ENTRY)
+
+    def aim_at_farm(self, c):
+        target = self.map.find_nearest_farm(c.x, c.y)
+        if target:
+            c.target = (target.x, target.y)
+            return True
+        return False
+
+    # State handlers: each runs one tick for a creature in its state and
+    # returns True when that ends the creature's tick early
+
+    def seek_wage(self, c):
+        if not c.target:
+            # Simplified: Go to Heart preferably or Treasury.
+            c.target = self.map.heart_pos
+
+        ix, iy = c.x, c.y
+        tx, ty = c.target
+        dist = max(abs(ix - tx), abs(iy - ty))
+        if dist <= 1:
+            if self.deduct_gold(c.wage):
+                c.state = STATE_IDLE
+                c.target = None
+            else:
+                c.state = STATE_IDLE
+        else:
+            path = self.route_step(c, tx, ty)
+            if path: c.x, c.y = path
+        return True
+
+    def look_for_bed(self, c):
+        if not self.facilities.bed(c.id) and not c.building_bed:
+            target_spot = self.facilities.nearest_free_lair(c.x, c.y, c.id)
+            if target_spot:
+                c.target = (target_spot.x, target_spot.y)
+                c.state = STATE_CONSTRUCTING_BED
+                self.facilities.reserve(c.target, c.id)
+
+    def build_bed(self, c):
+        if not c.target:
+            c.state = STATE_IDLE
+            self.facilities.release(c.id)
+            return True
+        ix, iy = c.x, c.y
+        tx, ty = c.target
+        if (ix, iy) == (tx, ty):
+            tile = self.map.get_tile(ix, iy)
+            if tile.char == 'L' and self.map.is_valid_bed_spot(ix, iy):
+                tile.char = TILES_BED
+                tile.creator_type = c.type
+                self.map.tile_changed(ix, iy)
+                self.facilities.assign_bed((ix, iy), c.id)
+            self.facilities.release(c.id)
+            c.state = STATE_IDLE
+            c.target = None
+        else:
+            path = self.route_step(c, tx, ty)
+            if path: c.x, c.y = path
+            else:
+                c.state = STATE_IDLE
+                self.facilities.release(c.id)
+        return True
+
+    def choose_training(self, c):
+        # Target dummy first, otherwise any training tile
+        dummy_pos = self.facilities.nearest_dummy(c.x, c.y)
+        if dummy_pos:
+            c.target = dummy_pos
+            c.state = STATE_TRAINING
+        else:
+            tile = self.map.find_nearest_training_tile(c.x, c.y)
+            if tile:
+                c.target = (tile.x, tile.y)
+                c.state = STATE_TRAINING
+            else:
+                c.state = STATE_IDLE
+
+    def train(self, c):
+        if not c.target or c.level >= 4:
+            c.state = STATE_IDLE
+            return True
+
+        ix, iy = c.x, c.y
+        tx, ty = c.target
+        dist = max(abs(ix - tx), abs(iy - ty))
+
+        # Check if target is a dummy or just a training room tile
+        is_dummy = self.facilities.is_dummy((tx, ty))
+        valid_training_spot = dist <= 1 if is_dummy else (dist == 0) # Must stand on tile if no dummy
+
+        if valid_training_spot:
+            # Pay for training (1 gold per tick, roughly 10 per 10)
+            if not self.deduct_gold(1):
+                c.state = STATE_IDLE # Can't afford
+                return True
+
+            c.xp += 1
+            self.check_level_up(c)
+
+            moves = []
+            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
+                nx, ny = ix + dx, iy + dy
+                t = self.map.get_tile(nx, ny)
+                # Exclude dummy locations
+                if t and not t.is_solid and t.char == TILES_TRAINING and not self.facilities.is_dummy((nx, ny)):
+                    moves.append((nx, ny))
+
+            if moves:
+                nx, ny = random.choice(moves)
+                c.x, c.y = nx, ny
+        else:
+            path = self.route_step(c, tx, ty)
+            if path: c.x, c.y = path
+            else: c.state = STATE_IDLE
+        return True
+
+    def walk_to_farm(self, c):
+        if not c.target:
+            c.state = STATE_IDLE
+            return True
+        tx, ty = c.target
+        if (c.x, c.y) == (tx, ty):
+            c.state = STATE_EATING
+        else:
+            path = self.route_step(c, tx, ty)
+            if path: c.x, c.y = path
+            else: c.state = STATE_IDLE
+        return True
+
+    def eat(self, c):
+        c.hunger -= 5
+        if c.hunger <= 0:
+            c.hunger = 0
+            c.state = STATE_IDLE
+        return True
+
+    def patrol(self, c):
+        if not c.target or (c.x, c.y) == c.target:
+            rx = random.randint(1, self.map.width - 2)
+            ry = random.randint(1, self.map.height - 2)
+            t = self.map.get_tile(rx, ry)
+            if t and not t.is_solid:
+                c.target = (rx, ry)
+            else:
+                c.state = STATE_IDLE
+            return True
+
+        tx, ty = c.target
+        path = self.route_step(c, tx, ty)
+        if path:
+            c.x, c.y = path
+        else:
+            c.state = STATE_IDLE
+            c.target = None
+        return True
+
+    def drop_stale_job(self, imp):
+        # Anything but carrying, fetching or working a job goes back to IDLE
+        if imp.state not in IMP_STATES:
+            imp.target = None
+            imp.state = STATE_IDLE
+            imp.work_timer = 0
+
+    def return_gold(self, imp):
+        # Deposit at Heart (limit 5000) or Treasury (500 per tile)
+        ix, iy = imp.x, imp.y
+        if not imp.target:
+            if self.heart_gold < 5000:
+                imp.target = self.map.heart_pos
+            else:
+                t_pos = self.map.get_flow_goal(ix, iy, FLOW_TREASURY)
+                if t_pos:
+                    imp.target = t_pos
                 else:
-                    path = self.map.get_path_step(ix, iy, tx, ty)
-                    if path: 
-                        imp['x'], imp['y'] = path
-                        
-            elif imp['state'] == 'DIGGING':
-                tx, ty = imp['target']
-                t_tile = self.map.get_tile(tx, ty)
-                
-                # Logic:
-                # If Gold: Mine (+100g). If deplete (500g total), turn to floor.
-                # If Rock: Dig (1 tick) -> Floor.
-                                # Mining Logic (Unified)
-                if t_tile.char in [TILES_GOLD, TILES_GEM]:
-                     if t_tile.char == TILES_GEM:
-                         # 3x longer to mine. Regular yields 100g per 1 tick.
-                         # Require 3 ticks per extraction.
-                         if t_tile.progress < 2:
-                             t_tile.progress += 1
-                             imp['xp'] += 1
-                             self.check_level_up(imp)
-                             continue
-                         t_tile.progress = 0
-                         
-                         mine_amt = 100
-                         mined = mine_amt
-                         # Gem seams provide infinite gold
-                     else:
-                         mine_amt = 100
-                         available = t_tile.gold_value
-                         
-                         # 1. Mine the rock (reduce availability)
-                         if available > mine_amt:
-                             mined = mine_amt
-                             t_tile.gold_value -= mine_amt
-                         else:
-                             mined = available
-                             t_tile.gold_value = 0
-                     
-                     # 2. Add to Imp if capacity exists
-                     space = 300 - imp['gold']
-                     to_floor = mined
-                     
-                     if space > 0:
-                         to_inv = min(mined, space)
-                         imp['gold'] += to_inv
-                         to_floor -= to_inv
-                    
-                     # 3. Handle Dropped Gold & Destroyed block
-                     if t_tile.gold_value <= 0 and t_tile.char != TILES_GEM:
-                         t_tile.char = TILES_FLOOR
-                         t_tile.is_solid = False
-                         t_tile.tagged = False
-                         t_tile.gold_value = to_floor + t_tile.gold_stored # Place dropped gold
-                         t_tile.gold_stored = 0
-                         imp['target'] = None
-                         # If full, return gold, else go idle
-                         if imp['gold'] >= 300:
-                             imp['state'] = 'RETURNING_GOLD'
-                         else:
-                             imp['state'] = 'IDLE'
-                     else:
-                         # Not destroyed yet (or is Gem seam)
-                         t_tile.gold_stored += to_floor
-                         
-                     # 4. If Imp is full of gold, force it to return
-                     if imp['gold'] >= 300:
-                         imp['target'] = None
-                         imp['state'] = 'RETURNING_GOLD'
-                         
-                elif t_tile.char == TILES_REINFORCED:
-                    # Reinforced digging takes longer
-                    # Soft rock HP = 10.
-                    # Player reinforced HP = 30 (3x longer).
-                    # Enemy reinforced HP = 50 (5x longer).
-                    target_hp = 30 if getattr(t_tile, 'owner', 0) == 0 else 50
-                     
-                    power = 10 * imp['level']
-                    t_tile.progress += power
-                     
-                    # Grant XP
-                    imp['xp'] += 1
+                    # Treasuries and Heart are full. Fall back to IDLE.
+                    imp.state = STATE_IDLE
+                    imp.target = None
+                    return True
+
+        tx, ty = imp.target
+
+        # If target is Heart, we check adjacency
+        deposit_ready = False
+        t_tile_target = self.map.get_tile(tx, ty)
+
+        if t_tile_target and t_tile_target.char == TILES_HEART:
+            dist = max(abs(ix - tx), abs(iy - ty))
+            if dist <= 1:
+                deposit_ready = True
+        else:
+            if (ix, iy) == (tx, ty):
+                deposit_ready = True
+            elif self.map.treasury.space_at(ix, iy) > 0:
+                # Following the treasury flow field can land us on an equally near tile
+                imp.target = (ix, iy)
+                t_tile_target = self.map.get_tile(ix, iy)
+                deposit_ready = True
+
+        if deposit_ready:
+            tile = t_tile_target # The target (Heart or Treasury)
+            amount = imp.gold
+            deposit = 0
+
+            if tile.char == TILES_HEART:
+                space = 5000 - self.heart_gold
+                deposit = min(amount, space)
+                self.heart_gold += deposit
+            elif tile.char == TILES_TREASURY:
+                deposit = self.map.treasury.deposit(tile.x, tile.y, amount)
+
+            if deposit > 0:
+                self.total_gold += deposit
+                imp.gold -= deposit
+                self.check_gold()
+
+            if imp.gold <= 0:
+                imp.state = STATE_IDLE # Done
+                imp.target = None
+            else:
+                imp.target = None # Re-eval target next tick because maybe this tile is now full
+        else:
+            if t_tile_target and t_tile_target.char == TILES_TREASURY:
+                next_pos = self.map.get_flow_step(ix, iy, FLOW_TREASURY)
+            else:
+                next_pos = self.route_step(imp, tx, ty)
+            if next_pos:
+                imp.x, imp.y = next_pos
+
+    def pick_up_gold(self, imp):
+        if not imp.target:
+            imp.state = STATE_IDLE
+            return True
+        tx, ty = imp.target
+        if (imp.x, imp.y) == (tx, ty):
+            t_tile = self.map.get_tile(tx, ty)
+            if t_tile.gold_value > 0:
+                space = 300 - imp.gold
+                pickup = min(space, t_tile.gold_value)
+                imp.gold += pickup
+                t_tile.gold_value -= pickup
+
+                if t_tile.gold_value <= 0:
+                    t_tile.char = TILES_FLOOR # Reset char to floor if depleted
+                self.map.tile_changed(tx, ty)
+
+            found_next = False
+            if imp.gold < 300:
+                for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
+                    nx, ny = tx + dx, ty + dy
+                    if (nx, ny) in self.map.floor_gold.tiles:
+                        taken = self.targets.taken((nx, ny), imp.id)
+                        if not taken:
+                            imp.target = (nx, ny)
+                            imp.state = STATE_MOVING_PICKUP
+                            found_next = True
+                            break
+
+            if not found_next:
+                imp.target = None
+                imp.state = STATE_IDLE
+        else:
+            path = self.route_step(imp, tx, ty)
+            if path:
+                imp.x, imp.y = path
+            else:
+                imp.target = None # Unreachable
+                imp.state = STATE_IDLE
+
+    def walk_to_job(self, imp):
+        if not imp.target:
+            imp.state = STATE_IDLE
+            return True
+        tx, ty = imp.target
+
+        # Check adjacency (Chebyshev distance for diagonals)
+        dist = max(abs(imp.x - tx), abs(imp.y - ty))
+        if dist <= 1:
+            # Start Working
+            if imp.state == STATE_MOVING_DIG:
+                imp.state = STATE_DIGGING
+                imp.work_timer = 0
+            elif imp.state == STATE_MOVING_REINFORCE:
+                imp.state = STATE_REINFORCING
+                imp.work_timer = 0
+            elif dist == 0:
+                # Claiming requires standing on top
+                imp.state = STATE_CLAIMING
+                imp.work_timer = 0
+            else:
+                # Keep moving closer if adjacent
+                path = self.route_step(imp, tx, ty)
+                if path:
+                    imp.x, imp.y = path
+        else:
+            path = self.route_step(imp, tx, ty)
+            if path:
+                imp.x, imp.y = path
+
+    def dig(self, imp):
+        tx, ty = imp.target
+        t_tile = self.map.get_tile(tx, ty)
+
+        # If Gold: Mine (+100g). If deplete (500g total), turn to floor.
+        # If Rock: Dig (1 tick) -> Floor.
+        if t_tile.char in [TILES_GOLD, TILES_GEM]:
+            if t_tile.char == TILES_GEM:
+                # 3x longer to mine. Regular yields 100g per 1 tick.
+                # Require 3 ticks per extraction.
+                if t_tile.progress < 2:
+                    t_tile.progress += 1
+                    imp.xp += 1
                     self.check_level_up(imp)
+                    return True
+                t_tile.progress = 0
 
-                    if t_tile.progress >= target_hp:
-                        t_tile.char = TILES_FLOOR
-                        t_tile.is_solid = False
-                        t_tile.tagged = False
-                        t_tile.progress = 0
-                         
-                        # Stickiness: find adjacent tagged tile to dig
-                        found_next = False
-                        for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                            nx, ny = tx + dx, ty + dy
-                            nt = self.map.get_tile(nx, ny)
-                            if nt and nt.tagged:
-                                taken = False
-                                for other in self.creatures:
-                                    if other['id'] != imp['id'] and other['target'] == (nx, ny):
-                                        taken = True
-                                        break
-                                if not taken:
-                                    imp['target'] = (nx, ny)
-                                    imp['state'] = 'MOVING_DIG'
-                                    found_next = True
-                                    break
-                                     
-                        if not found_next:
-                            imp['target'] = None
-                            imp['state'] = 'IDLE'
+                # Gem seams provide infinite gold
+                mined = 100
+            else:
+                mine_amt = 100
+                available = t_tile.gold_value
+
+                # 1. Mine the rock (reduce availability)
+                if available > mine_amt:
+                    mined = mine_amt
+                    t_tile.gold_value -= mine_amt
                 else:
-                    # Normal Dig (Soft Rock)
-                    # HP = 10.
-                    power = 10 * imp['level']
-                    t_tile.progress += power
-                     
-                    imp['xp'] += 1
-                    self.check_level_up(imp)
-                     
-                    if t_tile.progress >= 10:
-                        t_tile.char = TILES_FLOOR
-                        t_tile.is_solid = False
-                        t_tile.tagged = False
-                        t_tile.progress = 0
-                         
-                        # Stickiness: find adjacent tagged tile to dig
-                        found_next = False
-                        for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                            nx, ny = tx + dx, ty + dy
-                            nt = self.map.get_tile(nx, ny)
-                            if nt and nt.tagged:
-                                taken = False
-                                for other in self.creatures:
-                                    if other['id'] != imp['id'] and other['target'] == (nx, ny):
-                                        taken = True
-                                        break
-                                if not taken:
-                                    imp['target'] = (nx, ny)
-                                    imp['state'] = 'MOVING_DIG'
-                                    found_next = True
-                                    break
-                                     
-                        if not found_next:
-                            imp['target'] = None
-                            imp['state'] = 'IDLE'
-
-            elif imp['state'] == 'REINFORCING':
-                tx, ty = imp['target']
-                t_tile = self.map.get_tile(tx, ty)
-                
-                # Reinforce logic
-                # Target: Soft Rock.
-                # HP to become Reinforced: 30.
-                power = 10 * imp['level']
-                t_tile.progress += power
-
-                imp['xp'] += 1
-                self.check_level_up(imp)
-
-                if t_tile.progress >= 30:
-                    t_tile.char = TILES_REINFORCED
-                    t_tile.is_solid = True # Should be solid
-                    t_tile.progress = 0
-                    
-                    # Stickiness: find another reinforceable wall nearby
-                    found_next = False
-                    for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                        nx, ny = tx + dx, ty + dy
-                        nt = self.map.get_tile(nx, ny)
-                        if nt and nt.char == TILES_SOFT_ROCK and not nt.tagged:
-                            # Is it exposed to empty space?
-                            exposed = False
-                            for ex, ey in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                                et = self.map.get_tile(nx + ex, ny + ey)
-                                if et and not et.is_solid:
-                                    exposed = True
-                                    break
-                            
-                            if exposed:
-                                taken = False
-                                for other in self.creatures:
-                                    if other['id'] != imp['id'] and other['target'] == (nx, ny):
-                                        taken = True
-                                        break
-                                if not taken:
-                                    imp['target'] = (nx, ny)
-                                    imp['state'] = 'MOVING_REINFORCE'
-                                    found_next = True
-                                    break
-                                    
-                    if not found_next:
-                        imp['target'] = None
-                        imp['state'] = 'IDLE'
-            
-            elif imp['state'] == 'CLAIMING':
-                 tx, ty = imp['target']
-                 t_tile = self.map.get_tile(tx, ty)
-                 
-                 if t_tile.claimed:
-                     imp['state'] = 'IDLE'
-                     imp['target'] = None
-                     continue
-                 
-                 imp['work_timer'] += 1
-                 if imp['work_timer'] >= 2:
-                     t_tile.claimed = True
-                     imp['xp'] += 1
-                     self.check_level_up(imp) # Grants XP?
-                     
-                     # Stickiness: find another unclaimed tile adjacent to this one
-                     found_next = False
-                     for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
-                         nx, ny = tx + dx, ty + dy
-                         if 0 <= nx < self.map.width and 0 <= ny < self.map.height:
-                             nt = self.map.get_tile(nx, ny)
-                             if nt and not nt.claimed and not nt.is_solid:
-                                 # Ensure no other imp is already claiming this (basic check)
-                                 taken = False
-                                 for other in self.creatures:
-                                     if other['id'] != imp['id'] and other['target'] == (nx, ny):
-                                         taken = True
-                                         break
-                                 if not taken:
-                                     imp['target'] = (nx, ny)
-                                     imp['state'] = 'MOVING_CLAIM'
-                                     imp['work_timer'] = 0
-                                     found_next = True
-                                     break
-                     
-                     if not found_next:
-                         imp['state'] = 'IDLE'
-                         imp['target'] = None
-            
-            elif imp['state'] == 'IDLE':
-                # Random wander
-                imp['idle_timer'] += 1
-                if imp['idle_timer'] >= 2:
-                    imp['idle_timer'] = 0
-                    neighbors = []
-                    for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                        nx, ny = ix + dx, iy + dy
-                        t = self.map.get_tile(nx, ny)
-                        if t and not t.is_solid:
-                            neighbors.append((nx, ny))
-                    if neighbors:
-                        nx, ny = random.choice(neighbors)
-                        imp['x'] = nx
-                        imp['y'] = ny
-
-            # Happiness Check
-            if c['happiness'] <= -10 and c['state'] != 'LEAVING':
-                c['state'] = 'LEAVING'
-                c['target'] = self.map.portal_pos
-            
-            if c['state'] == 'LEAVING':
-                px, py = self.map.portal_pos
-                if (c['x'], c['y']) == (px, py):
-                     # Leave
-                    bed_pos = None
-                    for pos, owner_id in self.bed_ownership.items():
-                        if owner_id == c['id']:
-                            bed_pos = pos
-                            break
-                    if bed_pos:
-                        del self.bed_ownership[bed_pos]
-                        tile = self.map.get_tile(*bed_pos)
-                        tile.char = 'L'
-                        
-                    self.creatures.remove(c)
-                    continue
+                    mined = available
+                    t_tile.gold_value = 0
+
+            # 2. Add to Imp if capacity exists
+            space = 300 - imp.gold
+            to_floor = mined
+
+            if space > 0:
+                to_inv = min(mined, space)
+                imp.gold += to_inv
+                to_floor -= to_inv
+
+            # 3. Handle Dropped Gold & Destroyed block
+            if t_tile.gold_value <= 0 and t_tile.char != TILES_GEM:
+                t_tile.char = TILES_FLOOR
+                self.map.set_solid(tx, ty, False)
+                self.map.set_tagged(tx, ty, False)
+                t_tile.gold_value = to_floor + t_tile.gold_stored # Place dropped gold
+                t_tile.gold_stored = 0
+                self.map.tile_changed(tx, ty)
+                imp.target = None
+                # If full, return gold, else go idle
+                if imp.gold >= 300:
+                    imp.state = STATE_RETURNING_GOLD
                 else:
-                    path = self.map.get_path_step(c['x'], c['y'], px, py)
-                    if path: c['x'], c['y'] = path
+                    imp.state = STATE_IDLE
+            else:
+                # Not destroyed yet (or is Gem seam)
+                t_tile.gold_stored += to_floor
 
-        # Spawn Dummies Check (End of Update)
-        if self.payday_timer % 10 == 0:
-            for y in range(1, self.map.height - 1):
-                for x in range(1, self.map.width - 1):
-                    t = self.map.get_tile(x, y)
-                    if t.char == TILES_TRAINING:
-                        is_center = True
-                        for dy in [-1, 0, 1]:
-                            for dx in [-1, 0, 1]:
-                                if self.map.get_tile(x + dx, y + dy).char != TILES_TRAINING:
-                                    is_center = False
-                                    break
-                            if not is_center: break
-                        
-                        if is_center:
-                            has_dummy_nearby = False
-                            for c in self.creatures:
-                                if c['type'] == 'DUMMY' and abs(c['x'] - x) <= 1 and abs(c['y'] - y) <= 1:
-                                    has_dummy_nearby = True
-                                    break
-                            
-                            if not has_dummy_nearby:
-                                self.spawn_creature('DUMMY', x, y)
-                                self.map.tiles[y][x].is_solid = True
+            # 4. If Imp is full of gold, force it to return
+            if imp.gold >= 300:
+                imp.target = None
+                imp.state = STATE_RETURNING_GOLD
+            return
+
+        # Soft rock HP = 10.
+        # Player reinforced HP = 30 (3x longer).
+        # Enemy reinforced HP = 50 (5x longer).
+        if t_tile.char == TILES_REINFORCED:
+            target_hp = 30 if getattr(t_tile, 'owner', 0) == 0 else 50
+        else:
+            target_hp = 10
+
+        power = 10 * imp.level
+        t_tile.progress += power
+
+        # Grant XP
+        imp.xp += 1
+        self.check_level_up(imp)
+
+        if t_tile.progress >= target_hp:
+            t_tile.char = TILES_FLOOR
+            self.map.set_solid(tx, ty, False)
+            self.map.set_tagged(tx, ty, False)
+            t_tile.progress = 0
+
+            # Stickiness: find adjacent tagged tile to dig
+            found_next = False
+            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
+                nx, ny = tx + dx, ty + dy
+                nt = self.map.get_tile(nx, ny)
+                if nt and nt.tagged:
+                    taken = self.targets.taken((nx, ny), imp.id)
+                    if not taken:
+                        imp.target = (nx, ny)
+                        imp.state = STATE_MOVING_DIG
+                        found_next = True
+                        break
+
+            if not found_next:
+                imp.target = None
+                imp.state = STATE_IDLE
+
+    def reinforce(self, imp):
+        tx, ty = imp.target
+        t_tile = self.map.get_tile(tx, ty)
+
+        # Target: Soft Rock.
+        # HP to become Reinforced: 30.
+        power = 10 * imp.level
+        t_tile.progress += power
+
+        imp.xp += 1
+        self.check_level_up(imp)
+
+        if t_tile.progress >= 30:
+            t_tile.char = TILES_REINFORCED
+            self.map.set_solid(tx, ty, True) # Should be solid
+            self.map.tile_changed(tx, ty)
+            t_tile.progress = 0
+
+            # Stickiness: find another reinforceable wall nearby
+            found_next = False
+            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
+                nx, ny = tx + dx, ty + dy
+                nt = self.map.get_tile(nx, ny)
+                # Dirt wall exposed to empty space?
+                if nt and self.map.walls.tiles.get((nx, ny)) == TILES_SOFT_ROCK and not nt.tagged:
+                    taken = self.targets.taken((nx, ny), imp.id)
+                    if not taken:
+                        imp.target = (nx, ny)
+                        imp.state = STATE_MOVING_REINFORCE
+                        found_next = True
+                        break
+
+            if not found_next:
+                imp.target = None
+                imp.state = STATE_IDLE
+
+    def claim(self, imp):
+        tx, ty = imp.target
+        t_tile = self.map.get_tile(tx, ty)
+
+        if t_tile.claimed:
+            imp.state = STATE_IDLE
+            imp.target = None
+            return True
+
+        imp.work_timer += 1
+        if imp.work_timer >= 2:
+            self.map.set_claimed(tx, ty)
+            imp.xp += 1
+            self.check_level_up(imp)
+
+            # Stickiness: find another unclaimed tile adjacent to this one
+            found_next = False
+            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)]:
+                nx, ny = tx + dx, ty + dy
+                if 0 <= nx < self.map.width and 0 <= ny < self.map.height:
+                    nt = self.map.get_tile(nx, ny)
+                    if nt and not nt.claimed and not nt.is_solid:
+                        # Ensure no other imp is already claiming this (basic check)
+                        taken = self.targets.taken((nx, ny), imp.id)
+                        if not taken:
+                            imp.target = (nx, ny)
+                            imp.state = STATE_MOVING_CLAIM
+                            imp.work_timer = 0
+                            found_next = True
+                            break
+
+            if not found_next:
+                imp.state = STATE_IDLE
+                imp.target = None
+
+    def wander(self, imp):
+        imp.idle_timer += 1
+        if imp.idle_timer >= 2:
+            imp.idle_timer = 0
+            neighbors = []
+            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
+                nx, ny = imp.x + dx, imp.y + dy
+                t = self.map.get_tile(nx, ny)
+                if t and not t.is_solid:
+                    neighbors.append((nx, ny))
+            if neighbors:
+                nx, ny = random.choice(neighbors)
+                imp.x = nx
+                imp.y = ny
+
+    def check_mood(self, c):
+        if c.happiness <= -10 and c.state != STATE_LEAVING:
+            c.state = STATE_LEAVING
+            c.target = self.map.portal_pos
+
+    def leave(self, c):
+        px, py = self.map.portal_pos
+        if (c.x, c.y) == (px, py):
+            self.facilities.release(c.id)
+            bed_pos = self.facilities.free_bed(c.id)
+            if bed_pos:
+                tile = self.map.get_tile(*bed_pos)
+                tile.char = 'L'
+                self.map.tile_changed(*bed_pos)
+
+            self.creatures.remove(c)
+            self.targets.remove(c)
+            self.grid.remove(c)
+            return True
+        path = self.route_step(c, px, py)
+        if path: c.x, c.y = path
 
 class Renderer:
     def __init__(self, stdscr, game_map):
@@ -1653,7 +3968,7 @@ class Renderer:
         curses.init_pair(COLOR_SPLASH_CYAN, curses.COLOR_CYAN, curses.COLOR_BLACK)
         curses.init_pair(COLOR_SPLASH_BLACK, curses.COLOR_BLACK, curses.COLOR_BLACK)
 
-    def draw(self, paused, creatures, selected_room, drag_start=None, drag_end=None, total_gold=0, selected_entity=None, mana=0):
+    def draw(self, paused, creature_grid, selected_room, drag_start=None, drag_end=None, total_gold=0, selected_entity=None, mana=0):
         # Removed self.stdscr.clear() to reduce flicker. 
         # We overwrite the entire viewport anyway.
         h, w = self.stdscr.getmaxyx()
@@ -1683,18 +3998,8 @@ class Renderer:
                    
                    # Dynamic Wall Rendering (Dirt Walls)
                    if char == TILES_SOFT_ROCK or char == TILES_GOLD:
-                       # Check neighbors for floor
-                       has_floor_neighbor = False
-                       for dy in [-1, 0, 1]:
-                           for dx in [-1, 0, 1]:
-                               if dx==0 and dy==0: continue
-                               nx, ny = map_x + dx, map_y + dy
-                               if 0 <= nx < self.map.width and 0 <= ny < self.map.height:
-                                   nt = self.map.tiles[ny][nx]
-                                   if not nt.is_solid: # Floor or Heart etc
-                                       has_floor_neighbor = True
-                                       break
-                           if has_floor_neighbor: break
+                       # Neighbors with floor (Floor or Heart etc)?
+                       has_floor_neighbor = (map_x, map_y) in self.map.walls.tiles
                        
                        if has_floor_neighbor:
                            if char == TILES_SOFT_ROCK:
@@ -1777,28 +4082,28 @@ class Renderer:
                    except curses.error:
                        pass
         
-        # Draw Creatures
-        for c in creatures:
-            scr_x = c['x'] - self.cam_x
-            scr_y = c['y'] - self.cam_y
+        # Draw Creatures (only those inside the viewport)
+        for c in creature_grid.in_rect(self.cam_x, self.cam_y, self.cam_x + w - 1, self.cam_y + h - 2):
+            scr_x = c.x - self.cam_x
+            scr_y = c.y - self.cam_y
             if 0 <= scr_x < w and 0 <= scr_y < h - 1:
                 # Type rendering
                 char = 'i'
                 pair = COLOR_IMP
                 
-                if c['type'] == 'GOBARR':
+                if c.type == 'GOBARR':
                     char = 'g'
                     pair = COLOR_GOBARR 
-                elif c['type'] == 'DUMMY':
+                elif c.type == 'DUMMY':
                     char = 'O'
                     pair = COLOR_DUMMY
 
                 attr = curses.color_pair(pair) | curses.A_BOLD
-                if c.get('gold', 0) > 0: # Carry gold visual
+                if c.gold > 0: # Carry gold visual
                      attr = curses.color_pair(COLOR_GOLD) | curses.A_BOLD
                 
                 # State visuals?
-                if c.get('state') == 'UNCONSCIOUS':
+                if c.state == STATE_UNCONSCIOUS:
                     char = 'X' 
                     attr = curses.color_pair(curses.COLOR_RED) | curses.A_DIM
                 
@@ -1823,30 +4128,30 @@ class Renderer:
             
             # Map state to descriptive text
             state_map = {
-                'IDLE': "Idle",
-                'PATROLLING': "Patrolling",
-                'MOVING_DIG': "Going to dig",
-                'DIGGING': "Digging",
-                'RETURNING_GOLD': "Carrying gold",
-                'MOVING_PICKUP': "Going to pick up gold",
-                'MOVING_REINFORCE': "Going to reinforce",
-                'REINFORCING': "Reinforcing",
-                'MOVING_DROP': "Dropping gold",
-                'SEEKING_WAGE': "Seeking Wage",
-                'CONSTRUCTING_BED': "Building Bed",
-                'TRAINING': "Training",
-                'MOVING_CLAIM': "Going to claim",
-                'CLAIMING': "Claiming land",
-                'EATING': "Eating",
-                'UNCONSCIOUS': "Unconscious"
+                STATE_IDLE: "Idle",
+                STATE_PATROLLING: "Patrolling",
+                STATE_MOVING_DIG: "Going to dig",
+                STATE_DIGGING: "Digging",
+                STATE_RETURNING_GOLD: "Carrying gold",
+                STATE_MOVING_PICKUP: "Going to pick up gold",
+                STATE_MOVING_REINFORCE: "Going to reinforce",
+                STATE_REINFORCING: "Reinforcing",
+                STATE_MOVING_DROP: "Dropping gold",
+                STATE_SEEKING_WAGE: "Seeking Wage",
+                STATE_CONSTRUCTING_BED: "Building Bed",
+                STATE_TRAINING: "Training",
+                STATE_MOVING_CLAIM: "Going to claim",
+                STATE_CLAIMING: "Claiming land",
+                STATE_EATING: "Eating",
+                STATE_UNCONSCIOUS: "Unconscious"
             }
-            s_text = state_map.get(ent.get('state'), ent.get('state'))
+            s_text = state_map.get(ent.state, STATE_NAMES.get(ent.state, ent.state))
             
-            imp_info = f"| {ent.get('name', '???')} (Lvl {ent.get('level',1)}) - {s_text} "
-            if ent['type'] == 'GOBARR':
-                 imp_info += f"| XP:{ent['xp']} HP:{ent['health']}/{ent['max_health']} DMG:{ent['damage']} Wage:{ent['wage']} Hap:{ent.get('happiness', 0)} Hun:{int(ent.get('hunger',0))}"
-            elif ent['type'] == 'IMP':
-                 imp_info += f"| XP:{ent['xp']} HP:{ent['health']}/{ent['max_health']} Hap:{ent.get('happiness', 0)}"
+            imp_info = f"| {ent.name} (Lvl {ent.level}) - {s_text} "
+            if ent.type == 'GOBARR':
+                 imp_info += f"| XP:{ent.xp} HP:{ent.health}/{ent.max_health} DMG:{ent.damage} Wage:{ent.wage} Hap:{ent.happiness} Hun:{int(ent.hunger)}"
+            elif ent.type == 'IMP':
+                 imp_info += f"| XP:{ent.xp} HP:{ent.health}/{ent.max_health} Hap:{ent.happiness}"
         
         final_status_l1 = (status_text + base_info).strip()
         final_status_l2 = imp_info.strip()
@@ -1914,6 +4219,7 @@ class SaveManager:
         with open(path, 'rb') as f:
             data = pickle.load(f)
             
+        game.map.path_service.close()
         game.map = data['map']
         game.entities = data['entities']
         game.renderer.map = game.map # Update renderer ref
@@ -2339,7 +4645,9 @@ class Game:
         # Standard curses sometimes misses this if TERM is generic
         pass
         
-        self.map = Map(113, 35) # Doubled area map
+        if hasattr(self, 'map'): # New Game over a running one
+            self.map.path_service.close()
+        self.map = Map(MAP_WIDTH, MAP_HEIGHT) # Doubled area map
         self.entities = EntityManager(self.map)
         self.renderer = Renderer(stdscr, self.map)
         
@@ -2385,6 +4693,9 @@ class Game:
         elif self.selected_room == "Training Room": cost_per_tile = 150
         elif self.selected_room == "Farm": cost_per_tile = 100
         
+        # One timestamp for the whole drag: its tiles are one job batch
+        stamp = time.time()
+
         # Apply Logic to Rect
         for ry in range(min_y, max_y + 1):
             for rx in range(min_x, max_x + 1):
@@ -2392,9 +4703,7 @@ class Game:
                 if tile:
                     # Tagging Logic (Soft Rock, Gold, Reinforced, Gem)
                     if tile.char in [TILES_SOFT_ROCK, TILES_GOLD, TILES_REINFORCED, TILES_GEM]:
-                        tile.tagged = drag_mode_tag
-                        if drag_mode_tag:
-                            tile.timestamp = time.time()
+                        self.map.set_tagged(rx, ry, drag_mode_tag, stamp if drag_mode_tag else None)
                         
                     elif tile.char == TILES_FLOOR or tile.char in ['P', 'L', TILES_TREASURY, '=', TILES_TRAINING, TILES_FARM]:
                         # Room assignments should overwrite one another
@@ -2442,12 +4751,17 @@ class Game:
                              # If we are overwriting '=' or gold char
                              
                              tile.char = char_to_apply
+                             stored_before = self.map.treasury.total
                              if char_to_apply == TILES_TREASURY:
                                 if tile.gold_value > 0 or old_char == '=':
                                      tile.gold_stored += tile.gold_value
                                      tile.gold_value = 0
                                 else:
                                      tile.gold_stored = 0
+                             self.map.tile_changed(rx, ry)
+                             # Absorbed dropped gold joins the treasury, gold on a painted-over one is gone
+                             self.entities.total_gold += self.map.treasury.total - stored_before
+                             self.entities.check_gold()
 
     def input(self):
         # Process all pending input
@@ -2543,10 +4857,7 @@ class Game:
                         # Usually release is safer for "Click vs Drag". 
                         # But simple click:
                         # Selection Cycling
-                        clicked_entities = []
-                        for c in self.entities.creatures:
-                            if c['x'] == map_x and c['y'] == map_y:
-                                clicked_entities.append(c)
+                        clicked_entities = self.entities.grid.at(map_x, map_y)
                         
                         if clicked_entities:
                             if self.selected_entity in clicked_entities:
@@ -2627,7 +4938,7 @@ class Game:
             
             # Render
             # Pass Mana
-            self.renderer.draw(self.paused, self.entities.creatures, self.selected_room, self.drag_start, self.drag_end, self.entities.total_gold, self.selected_entity, self.entities.mana)
+            self.renderer.draw(self.paused, self.entities.grid, self.selected_room, self.drag_start, self.drag_end, self.entities.total_gold, self.selected_entity, self.entities.mana)
             
             if self.menu.active:
                 self.menu.draw()
@@ -2638,6 +4949,9 @@ class Game:
             # Cap framerate to ~60 FPS
             curses.napms(16)
 
+        self.map.path_service.close()
+        PathService.shutdown(wait=True)
+
 def main(stdscr):
     game = Game(stdscr, start_in_menu=True)
     game.run()